@@ -5,38 +5,87 @@ AzureEnumRBAC.py
 Orchestrator that runs enumeration sub-scripts in the user's current directory,
 redirecting "output" references to <pwd>/AzureEnumRBAC/output.
 
+Each phase is imported and run in this interpreter (via its run() entry point)
+rather than in a fresh Python process, so shared imports are only paid once.
+Phases whose inputs are ready run concurrently (see PHASE_DEPENDENCIES).
+
 Usage:
-  AzureEnumRBAC
+  AzureEnumRBAC [--resume | --restart | --from PHASE] [--yes]
     (installed as a console_script entry point in pyproject.toml)
+
+Phase progress is also written to stderr as JSON lines, e.g.
+  {"t": 1700000000.0, "evt": "phase_done", "idx": 3, "name": "d_enumerate_roles"}
+with evt one of phase_start / phase_done / phase_fail, for external monitors.
+
+Without flags, an interactive terminal is asked whether to resume a previous
+run; a non-interactive one resumes automatically unless the run log is stale.
+With any flag, or without a terminal, phase a's prompts also take their default
+answer (no install, no new login; the existing az login is used).
 """
 
 import os
 import sys
-import subprocess
+import argparse
+import importlib
+import importlib.util
 import json
-import shutil
-import re
+import time
+import traceback
+import contextlib
+import concurrent.futures
 
-# The sub-scripts to run, in order:
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# The phase modules to run, in order:
 SCRIPTS_IN_ORDER = [
-    "a_login_or_install.py",
-    "b_get_subscriptions.py",
-    "c_enumerate_resources.py",
-    "d_enumerate_roles.py",
-    "e_enumerate_assignments.py",
-    "f_enumerate_group_members.py",
-    "g_combine_rbac_users.py",
-    "h_get_user_personal_data.py",
-    "i_combine_identities.py",
-    "j_role_matrix.py",
-    "k_user_matrix.py",
-    "l_bubble_chart_users.py",
-    "m_bubble_chart_roles.py"
+    "a_login_or_install",
+    "b_get_subscriptions",
+    "c_enumerate_resources",
+    "d_enumerate_roles",
+    "e_enumerate_assignments",
+    "f_enumerate_group_members",
+    "g_combine_rbac_users",
+    "h_get_user_personal_data",
+    "i_combine_identities",
+    "j_role_matrix",
+    "k_user_matrix",
+    "l_bubble_chart_users",
+    "m_bubble_chart_roles"
 ]
 
+# Which phases must finish before a phase may start, derived from the files each
+# phase reads. Anything whose dependencies are met runs in parallel with its peers.
+PHASE_DEPENDENCIES = {
+    "a_login_or_install":        [],
+    "b_get_subscriptions":       ["a_login_or_install"],
+    "c_enumerate_resources":     ["b_get_subscriptions"],
+    "d_enumerate_roles":         ["b_get_subscriptions"],
+    "e_enumerate_assignments":   ["b_get_subscriptions", "d_enumerate_roles"],
+    "f_enumerate_group_members": ["e_enumerate_assignments"],
+    "g_combine_rbac_users":      ["c_enumerate_resources", "e_enumerate_assignments",
+                                  "f_enumerate_group_members"],
+    "h_get_user_personal_data":  ["g_combine_rbac_users"],
+    "i_combine_identities":      ["g_combine_rbac_users", "h_get_user_personal_data"],
+    "j_role_matrix":             ["i_combine_identities"],
+    "k_user_matrix":             ["c_enumerate_resources", "i_combine_identities"],
+    "l_bubble_chart_users":      ["i_combine_identities"],
+    "m_bubble_chart_roles":      ["i_combine_identities"]
+}
+
+# Phases are network-bound (az CLI / Graph calls), so threads are sufficient.
+MAX_PARALLEL_PHASES = 6
+
 # Find where these sub-scripts actually live (the installed package directory).
 THIS_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Phase modules use sibling imports ("from helpers import ..."), exactly as when
+# they are run as standalone scripts, so their directory must be importable.
+if THIS_PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, THIS_PACKAGE_DIR)
+
 # The user’s current working directory:
 USER_CWD = os.getcwd()
 
@@ -45,48 +94,263 @@ USER_BASE_PATH = os.path.join(USER_CWD, "AzureEnumRBAC")
 USER_OUTPUT_DIR = os.path.join(USER_BASE_PATH, "output")
 USER_FINAL_DIR  = os.path.join(USER_BASE_PATH, "FINAL_OUTPUT")
 
-# We'll keep a small JSON log in <pwd>/AzureEnumRBAC/output/AzureEnumRBAC_run.log
+# We'll keep a small JSON log in <pwd>/AzureEnumRBAC/output/AzureEnumRBAC_run.log,
+# replaced atomically on every update, plus an append-only journal (.jsonl) of one
+# JSON line per finished phase that is replayed if the snapshot is ever unreadable.
+# Readers and writers serialize on an OS lock of a third file (.lock). See RunLog.
 RUN_LOG_FILE = os.path.join(USER_OUTPUT_DIR, "AzureEnumRBAC_run.log")
 
+# Output files with these prefixes are copied (prefix removed) into FINAL_OUTPUT.
+FINAL_PREFIXES = ("i_", "j_", "k_", "l_", "m_")
+
+# Set to "1" for the phases when the run is unattended, so phase a's prompts take
+# their default answer (see a_login_or_install.NONINTERACTIVE_ENV).
+NONINTERACTIVE_ENV = "AZUREENUMRBAC_NONINTERACTIVE"
+
+# Resuming from a log older than this risks mixing stale and fresh Azure data.
+STALE_RUN_LOG_SECONDS = 24 * 60 * 60
+
+
+class RunLog:
+    """
+    Progress of the current run, read from disk once and then kept in memory.
+
+    The lock and journal files stay open for the life of the object, so recording
+    a finished phase is one appended journal line plus an atomic snapshot replace.
+    """
+
+    def __init__(self, path=RUN_LOG_FILE):
+        self.path = path
+        self.journal_path = path + ".jsonl"
+        self.lock_fd = os.open(path + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+        self.completed, self.last_update = self._load()
+        self.journal_fd = os.open(self.journal_path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+
+    def close(self):
+        os.close(self.journal_fd)
+        os.close(self.lock_fd)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        """
+        Hold an OS-level lock on the .lock file: flock (shared or exclusive) on
+        POSIX, msvcrt.locking (always exclusive) on Windows.
+        """
+        if os.name == "nt":
+            os.lseek(self.lock_fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.lock_fd, msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                os.lseek(self.lock_fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.lock_fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
 
-def load_run_log():
-    """Load run log if present; return last_completed index or -1 if missing."""
-    if os.path.exists(RUN_LOG_FILE):
+    def _load(self):
+        """
+        Return (set of completed phase names, time of the last update). Falls back
+        to the journal if the snapshot can't be read, and returns (set(), None) if
+        there is no log at all.
+        """
+        with self._locked(exclusive=False):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return self._replay_journal()
+
+        if "completed" in data:
+            completed = set(data["completed"]) & set(SCRIPTS_IN_ORDER)
+        else:
+            # Older logs only recorded the index of the last phase run in sequence.
+            completed = set(SCRIPTS_IN_ORDER[:data.get("last_completed", -1) + 1])
+        return completed, data.get("timestamp", os.path.getmtime(self.path))
+
+    def _replay_journal(self):
+        """
+        Rebuild (completed phases, last update time) from the journal, skipping any
+        line that was only partially written when a previous run was killed.
+        """
+        completed, timestamp = set(), None
         try:
-            with open(RUN_LOG_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return data.get("last_completed", -1)
-        except Exception:
-            return -1
-    return -1
+            f = open(self.journal_path, "r", encoding="utf-8")
+        except OSError:
+            return completed, timestamp
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("status") == "reset":
+                    completed = set(record.get("completed", [])) & set(SCRIPTS_IN_ORDER)
+                elif record.get("status") == "ok" and record.get("phase") in SCRIPTS_IN_ORDER:
+                    completed.add(record["phase"])
+                timestamp = record.get("timestamp", timestamp)
+        return completed, timestamp
+
+    def mark_done(self, phase):
+        """Record that 'phase' finished."""
+        self.completed.add(phase)
+        self._write({"phase": phase, "timestamp": time.time(), "status": "ok"})
+
+    def reset(self, completed=()):
+        """Start the run over, treating only the phases in 'completed' as done."""
+        self.completed = set(completed)
+        self._write({"phase": None, "timestamp": time.time(), "status": "reset"}, truncate=True)
+
+    def _write(self, record, truncate=False):
+        """
+        Append 'record' to the journal (after truncating it, for a reset, so it
+        only ever covers the current run), then atomically replace the snapshot with
+        {'completed': [phase names, in phase order], 'timestamp': ..., 'status': 'ok'}.
+        """
+        completed_list = [name for name in SCRIPTS_IN_ORDER if name in self.completed]
+        if record["status"] == "reset":
+            record["completed"] = completed_list
+        data = {"completed": completed_list, "timestamp": record["timestamp"], "status": "ok"}
+        tmp_file = self.path + ".tmp"
 
+        with self._locked(exclusive=True):
+            if truncate:
+                os.ftruncate(self.journal_fd, 0)
+            os.write(self.journal_fd, (json.dumps(record) + "\n").encode("utf-8"))
+            os.fsync(self.journal_fd)
 
-def save_run_log(index):
-    """Write run log with {'last_completed': index}."""
-    data = {"last_completed": index}
-    with open(RUN_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        self.last_update = record["timestamp"]
+
+
+def stdin_is_terminal():
+    """True if stdin is an open terminal (False if it is a pipe, a file, or closed)."""
+    try:
+        return sys.stdin is not None and sys.stdin.isatty()
+    except ValueError:
+        return False
+
+
+def emit(evt, **fields):
+    """Write one machine-readable progress event to stderr as a JSON line."""
+    sys.stderr.write(json.dumps({"t": time.time(), "evt": evt, **fields}) + "\n")
+    sys.stderr.flush()
 
 
 def run_phase_script(script_name, index):
     """
-    Run a single sub-script from THIS_PACKAGE_DIR, but cwd=<pwd>/AzureEnumRBAC.
+    Import a single phase module from THIS_PACKAGE_DIR and call its run().
 
-    So if sub-script does 'os.makedirs("output", exist_ok=True)', it lands in
-    <pwd>/AzureEnumRBAC/output instead of the library install folder.
+    The caller has already changed into <pwd>/AzureEnumRBAC, so if the phase does
+    'os.makedirs("output", exist_ok=True)', it lands in <pwd>/AzureEnumRBAC/output
+    instead of the library install folder.
     """
-    script_path = os.path.join(THIS_PACKAGE_DIR, script_name)
-    if not os.path.exists(script_path):
-        print(f"[ERROR] Script not found in package: {script_path}")
+    print(f"[INFO] Running phase {index}: {script_name}")
+    try:
+        module = importlib.import_module(script_name)
+    except ImportError as e:
+        print(f"[ERROR] Could not import phase module {script_name}: {e}")
         sys.exit(1)
 
-    print(f"[INFO] Running phase {index}: {script_name}")
-    cmd = [sys.executable, script_path]
+    # Phases report failure via sys.exit(<non-zero>); treat that like check=True did.
+    # Any other exception is what a crashed subprocess used to be: a traceback and rc 1.
     try:
-        subprocess.run(cmd, check=True, cwd=USER_BASE_PATH)
-    except subprocess.CalledProcessError as e:
+        module.run()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f"[ERROR] Phase script failed: {script_name}")
+            sys.exit(e.code)
+    except Exception:
+        traceback.print_exc()
         print(f"[ERROR] Phase script failed: {script_name}")
-        sys.exit(e.returncode)
+        sys.exit(1)
+
+
+def find_missing_phases():
+    """
+    Return the phase modules from SCRIPTS_IN_ORDER that can't be found in
+    THIS_PACKAGE_DIR, so a broken install fails before any phase runs.
+    """
+    missing = []
+    for name in SCRIPTS_IN_ORDER:
+        spec = importlib.util.find_spec(name)
+        expected = os.path.join(THIS_PACKAGE_DIR, name + ".py")
+        if spec is None or not os.path.exists(expected):
+            missing.append(expected)
+    return missing
+
+
+def run_phases(run_log):
+    """
+    Run every phase not yet completed in 'run_log', starting each one as soon as
+    all of its PHASE_DEPENDENCIES have finished. The run log is updated (and
+    saved) as phases finish. If a phase fails, no new phases are started; the
+    ones already running are allowed to finish before the failure is re-raised.
+    """
+    completed = run_log.completed
+    pending = [name for name in SCRIPTS_IN_ORDER if name not in completed]
+    running = {}
+    failure = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_PHASES) as executor:
+        while running or (pending and failure is None):
+            if failure is None:
+                for name in list(pending):
+                    if all(dep in completed for dep in PHASE_DEPENDENCIES[name]):
+                        pending.remove(name)
+                        index = SCRIPTS_IN_ORDER.index(name)
+                        emit("phase_start", idx=index, name=name)
+                        running[executor.submit(run_phase_script, name, index)] = name
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                index = SCRIPTS_IN_ORDER.index(name)
+                try:
+                    future.result()
+                except SystemExit as e:
+                    emit("phase_fail", idx=index, name=name, rc=e.code)
+                    failure = failure or e
+                    continue
+                run_log.mark_done(name)
+                emit("phase_done", idx=index, name=name)
+
+    if failure is not None:
+        raise failure
+
+
+def copy_file(src, dst, size):
+    """
+    Copy src (of the given size) to dst inside the kernel with os.copy_file_range
+    where the platform supports it, otherwise via shutil.copy2. File metadata is
+    copied either way.
+    """
+    # Only needed once, at the very end of a run.
+    import errno
+    import shutil
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            shutil.copystat(src, dst)
+            return
+        except OSError as e:
+            # Not supported between these filesystems / by this kernel.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    shutil.copy2(src, dst)
 
 
 def copy_final_outputs():
@@ -94,21 +358,17 @@ def copy_final_outputs():
     Copy files from <pwd>/AzureEnumRBAC/output that start with i_, j_, k_, l_, or m_
     into <pwd>/AzureEnumRBAC/FINAL_OUTPUT, removing the prefix from each filename.
     """
-    if not os.path.exists(USER_FINAL_DIR):
-        os.makedirs(USER_FINAL_DIR, exist_ok=True)
+    os.makedirs(USER_FINAL_DIR, exist_ok=True)
 
-    pattern = re.compile(r'^[ijklm]_')
     final_filenames = []
 
-    for file_name in os.listdir(USER_OUTPUT_DIR):
-        if pattern.match(file_name):
-            old_path = os.path.join(USER_OUTPUT_DIR, file_name)
-            # remove first two chars: 'i_', 'j_', etc.
-            new_file_name = file_name[2:]
-            new_path = os.path.join(USER_FINAL_DIR, new_file_name)
-
-            if os.path.isfile(old_path):
-                shutil.copy2(old_path, new_path)
+    with os.scandir(USER_OUTPUT_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(FINAL_PREFIXES) and entry.is_file():
+                # remove first two chars: 'i_', 'j_', etc.
+                new_file_name = entry.name[2:]
+                new_path = os.path.join(USER_FINAL_DIR, new_file_name)
+                copy_file(entry.path, new_path, entry.stat().st_size)
                 final_filenames.append(new_file_name)
 
     if final_filenames:
@@ -122,45 +382,113 @@ def copy_final_outputs():
         print("\nNo matching final output files (i_, j_, k_, l_, m_) were found.\n")
 
 
+def resolve_phase(value):
+    """Map a phase name, with or without '.py', or its letter (e.g. 'f') to its module name."""
+    value = value.strip().lower()
+    if value.endswith(".py"):
+        value = value[:-3]
+    for name in SCRIPTS_IN_ORDER:
+        if value == name or value == name.split("_", 1)[0]:
+            return name
+    raise argparse.ArgumentTypeError(f"unknown phase '{value}'")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="AzureEnumRBAC",
+        description="Enumerate Azure subscriptions, resources, and RBAC roles."
+    )
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--resume", action="store_true",
+                       help="resume from the run log without prompting")
+    start.add_argument("--restart", action="store_true",
+                       help="ignore the run log and start from the first phase")
+    start.add_argument("--from", dest="from_phase", metavar="PHASE", type=resolve_phase,
+                       help="start at PHASE (name or letter, e.g. 'f'), treating earlier phases as done")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="don't prompt: resume an unfinished run, or re-run a finished one")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+    interactive = stdin_is_terminal() and not (
+        args.resume or args.restart or args.from_phase or args.yes
+    )
+
+
     # 1) Ensure <pwd>/AzureEnumRBAC/output exists (for logs + sub-script data)
-    if not os.path.exists(USER_OUTPUT_DIR):
-        os.makedirs(USER_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(USER_OUTPUT_DIR, exist_ok=True)
+
+    missing = find_missing_phases()
+    if missing:
+        print("[ERROR] Phase scripts not found in package:")
+        for path in missing:
+            print(f"  {path}")
+        sys.exit(1)
 
     total_scripts = len(SCRIPTS_IN_ORDER)
-    last_completed = load_run_log()
+    run_log = RunLog()
+    completed, last_update = run_log.completed, run_log.last_update
 
-    if last_completed < 0:
+    if args.restart:
+        print("[INFO] --restart given. Starting at phase #0 ...")
+        run_log.reset()
+    elif args.from_phase:
+        start_index = SCRIPTS_IN_ORDER.index(args.from_phase)
+        print(f"[INFO] --from given. Starting at phase #{start_index}: {args.from_phase}")
+        run_log.reset(SCRIPTS_IN_ORDER[:start_index])
+    elif not completed:
         # Fresh run
-        start_index = 0
         print("[INFO] No existing run log found in current directory. Starting at phase #0 ...")
-    else:
-        resume_index = last_completed + 1
-        if resume_index >= total_scripts:
-            print("[INFO] The run log indicates all scripts have completed already.")
+    elif len(completed) >= total_scripts:
+        print("[INFO] The run log indicates all scripts have completed already.")
+        if interactive:
             choice = input("Re-run everything from the beginning? [y/n]: ").strip().lower()
-            if choice == "y":
-                start_index = 0
-                save_run_log(-1)
-            else:
-                print("Okay, exiting.")
-                sys.exit(0)
         else:
-            script_next = SCRIPTS_IN_ORDER[resume_index]
-            print(f"[INFO] Found existing run log: last completed index = {last_completed}.")
-            print(f"[INFO] Next script is {resume_index}: {script_next}")
+            choice = "y" if args.yes else "n"
+        if choice == "y":
+            run_log.reset()
+        else:
+            print("Okay, exiting. (Use --restart to run everything again.)")
+            sys.exit(0)
+    else:
+        remaining = [name for name in SCRIPTS_IN_ORDER if name not in completed]
+        print(f"[INFO] Found existing run log: {len(completed)} of {total_scripts} phases completed.")
+        print(f"[INFO] Remaining phases: {', '.join(remaining)}")
+        stale = last_update and time.time() - last_update > STALE_RUN_LOG_SECONDS
+        if stale:
+            hours = (time.time() - last_update) / 3600
+            print(f"[WARNING] The run log was last updated {hours:.0f} hours ago; "
+                  f"Azure data may have changed since. Starting over is recommended.")
+        if interactive:
             choice = input("Resume (r) or start over (s)? [r/s]: ").strip().lower()
-            if choice == "s":
-                start_index = 0
-                save_run_log(-1)
-            else:
-                start_index = resume_index
+        elif stale and not args.resume:
+            # Only an explicit --resume may pick up a stale run unattended.
+            print("[INFO] Not auto-resuming a stale run. Starting over ...")
+            choice = "s"
+        else:
+            print("[INFO] Resuming without prompting.")
+            choice = "r"
+        if choice == "s":
+            run_log.reset()
 
-    # 2) Main loop
-    for i in range(start_index, total_scripts):
-        script_name = SCRIPTS_IN_ORDER[i]
-        run_phase_script(script_name, i)
-        save_run_log(i)
+    # 2) Run phases. They resolve "output" relative to the working directory and
+    #    some read optional paths from sys.argv, so present them with the same
+    #    environment a standalone "python <phase>.py" run would have.
+    #    Phases can't see our flags, so an unattended run is passed on via the
+    #    environment and their prompts (phase a) take the default answer.
+    if not interactive:
+        os.environ[NONINTERACTIVE_ENV] = "1"
+    saved_argv = sys.argv
+    os.chdir(USER_BASE_PATH)
+    try:
+        sys.argv = sys.argv[:1]
+        run_phases(run_log)
+    finally:
+        run_log.close()
+        sys.argv = saved_argv
+        os.chdir(USER_CWD)
 
     print("\n[INFO] All phases completed successfully.\n")
     copy_final_outputs()
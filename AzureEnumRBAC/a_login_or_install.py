@@ -5,13 +5,20 @@ a_login_or_install.py
 
 This script checks if the Azure CLI (az) is installed.
 If it isn't:
-  - On Windows, offers to install via MSI (32-bit or 64-bit)
-    using the snippet you provided (known to work).
+  - On Windows, offers to install via MSI (32-bit or 64-bit),
+    downloading the installer and running msiexec directly.
   - On Linux (Debian/Ubuntu), offers to run Microsoft's official
     install script via curl.
   - On macOS, offers to install via Homebrew.
 
-After installation, attempts 'az login' to authenticate the user.
+After installation, attempts 'az login' to authenticate the user, then caches
+an Azure Resource Manager token (output/token.json) and a Microsoft Graph token
+(~/.cache/azureenumrbac_msgraph_<tenant ID>.json) for the later phases.
+
+Unattended (no terminal on stdin, or AZUREENUMRBAC_NONINTERACTIVE=1, which the
+orchestrator sets for --yes/--resume/--restart/--from and non-TTY runs) every
+prompt takes its default answer: no install, no new login, and the tokens of the
+existing az login are cached.
 
 References:
   - Windows: https://learn.microsoft.com/en-us/cli/azure/install-azure-cli-windows
@@ -19,37 +26,58 @@ References:
   - macOS: https://learn.microsoft.com/en-us/cli/azure/install-azure-cli-macos
 """
 
+import os
 import subprocess
 import sys
 import platform
+import functools
+import shutil
+import urllib.request
+
+from helpers import get_arm_token, get_msgraph_token
+
+# Set to "1" by the AzureEnumRBAC orchestrator when it runs unattended
+NONINTERACTIVE_ENV = "AZUREENUMRBAC_NONINTERACTIVE"
+
+def is_interactive():
+    """True if prompts can be answered: stdin is a terminal and the orchestrator didn't say otherwise."""
+    if os.environ.get(NONINTERACTIVE_ENV) == "1":
+        return False
+    try:
+        return sys.stdin is not None and sys.stdin.isatty()
+    except ValueError:
+        # stdin closed
+        return False
+
+def ask(prompt, default="n"):
+    """
+    Returns the lowercased answer to prompt, or default (without waiting for input)
+    when the run is unattended.
+    """
+    if not is_interactive():
+        print(f"{prompt}{default} (non-interactive default)")
+        return default
+    return input(prompt).strip().lower()
 
 ##########################################
 #  Windows-Specific: REPLACED WITH YOURS #
 ##########################################
 
+@functools.lru_cache(maxsize=1)
 def is_az_installed_windows():
     """
-    Checks if the 'az' CLI is installed (Windows) by attempting
-    to run 'az --version' with shell=True.
-    Returns True if installed, False otherwise.
+    Checks if the 'az' CLI is installed (Windows) by looking for it on PATH
+    (shutil.which honours PATHEXT, so az.cmd is found).
+    Returns True if installed, False otherwise. The result is cached for the
+    rest of the run; call is_az_installed_windows.cache_clear() after installing.
     """
-    try:
-        subprocess.run(
-            ["az", "--version"],
-            check=True,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    return shutil.which("az") is not None
 
 
 def install_azure_cli_windows(architecture="32"):
     """
-    Installs the Azure CLI on Windows using PowerShell + MSI,
-    known-working snippet.
+    Installs the Azure CLI on Windows: streams the MSI to disk in 1 MiB chunks
+    and runs msiexec on it directly (no PowerShell wrapper).
     :param architecture: '32' or '64', defaults to '32'
     """
     if architecture == "64":
@@ -57,44 +85,36 @@ def install_azure_cli_windows(architecture="32"):
     else:
         download_url = "https://aka.ms/installazurecliwindows"
 
-    ps_command = (
-        f"$ProgressPreference = 'SilentlyContinue'; "
-        f"Invoke-WebRequest -Uri {download_url} -OutFile .\\AzureCLI.msi; "
-        f"Start-Process msiexec.exe -Wait -ArgumentList '/I AzureCLI.msi /quiet'; "
-        f"Remove-Item .\\AzureCLI.msi"
-    )
-
+    msi_path = "AzureCLI.msi"
     try:
-        subprocess.run(
-            [
-                "powershell",
-                "-NoProfile",
-                "-ExecutionPolicy", "Bypass",
-                "-Command", ps_command
-            ],
-            check=True
-        )
+        with urllib.request.urlopen(download_url) as resp, open(msi_path, "wb") as f:
+            shutil.copyfileobj(resp, f, length=1 << 20)
+        subprocess.run(["msiexec.exe", "/I", msi_path, "/quiet"], check=True)
         print("Azure CLI installation completed.")
-    except subprocess.CalledProcessError as e:
+    except (OSError, subprocess.CalledProcessError) as e:
         print("[ERROR] Failed to install Azure CLI.")
         print("Details:", e)
         sys.exit(1)
+    finally:
+        if os.path.exists(msi_path):
+            os.remove(msi_path)
 
 
 def login_to_azure_windows():
     """
-    Attempts to log in to Azure CLI (az login) with shell=True (Windows).
+    Attempts to log in to Azure CLI (az login) on Windows. az is a .cmd script
+    there, so it is run via its resolved path rather than through cmd.exe.
     """
     try:
         print("Login process initiated (wait for popup).")
         subprocess.run(
-            ["az", "login"],
+            [shutil.which("az") or "az.cmd", "login"],
             check=True,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
         print("Successfully logged in to Azure CLI.")
+        cache_arm_token()
     except subprocess.CalledProcessError as e:
         print("[ERROR] Failed to login with Azure CLI.")
         print("Details:", e)
@@ -104,20 +124,33 @@ def login_to_azure_windows():
 #   Linux/Mac Cross-Platform Portions (original) #
 ##################################################
 
+@functools.lru_cache(maxsize=1)
 def is_az_installed():
     """
-    Checks if the 'az' CLI is installed on non-Windows systems (or general check).
-    Returns True if installed, False otherwise.
+    Checks if the 'az' CLI is installed on non-Windows systems (or general check)
+    by looking for it on PATH, without starting the CLI itself.
+    Returns True if installed, False otherwise. The result is cached for the
+    rest of the run; call is_az_installed.cache_clear() after installing.
+    """
+    return shutil.which("az") is not None
+
+def verify_az_functional():
+    """
+    Runs 'az --version' once to confirm a freshly installed CLI actually starts.
+    Returns True if it does, False otherwise.
     """
+    az_path = shutil.which("az")
+    if not az_path:
+        return False
     try:
         subprocess.run(
-            ["az", "--version"],
+            [az_path, "--version"],
             check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    except (subprocess.CalledProcessError, OSError):
         return False
 
 def install_azure_cli_linux_deb():
@@ -142,7 +175,7 @@ def install_azure_cli_macos():
     """
     try:
         subprocess.run(["brew", "--version"], check=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except FileNotFoundError:
         print("[ERROR] Homebrew is not installed on this macOS system.")
         print("Install Homebrew first: https://brew.sh/")
@@ -166,15 +199,28 @@ def login_to_azure():
         subprocess.run(
             ["az", "login"],
             check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
         print("Successfully logged in to Azure CLI.")
+        cache_arm_token()
     except subprocess.CalledProcessError as e:
         print("[ERROR] Failed to login with Azure CLI.")
         print("Details:", e)
         sys.exit(1)
 
+def cache_arm_token():
+    """
+    Fetches ARM and Microsoft Graph access tokens from the logged-in CLI and caches
+    them so the enumeration phases can call the APIs without starting az. Both are
+    refreshed so a new login never reuses another account's cached token.
+    """
+    try:
+        get_arm_token(force_refresh=True)
+        get_msgraph_token(force_refresh=True)
+    except SystemExit:
+        print("[WARNING] Could not cache an Azure access token; later phases will request one.")
+
 ###########
 #  main()  #
 ###########
@@ -186,25 +232,27 @@ def main():
         # Use the known-working Windows snippet
         if is_az_installed_windows():
             print("Azure CLI is already installed on this Windows system.")
-            login_choice = input("Would you like to log in now? [y/n]: ").strip().lower()
+            login_choice = ask("Would you like to log in now? [y/n]: ")
             if login_choice == "y":
                 login_to_azure_windows()
             else:
                 print("Login skipped.")
+                cache_arm_token()
         else:
             print("Azure CLI is not installed on this Windows system.")
-            choice = input("Would you like to install Azure CLI now? [y/n]: ").strip().lower()
+            choice = ask("Would you like to install Azure CLI now? [y/n]: ")
             if choice == "y":
-                arch_choice = input("Which version would you like to install? [32/64]: ").strip()
+                arch_choice = ask("Which version would you like to install? [32/64]: ", default="32")
                 if arch_choice not in ["32", "64"]:
                     print("[ERROR] Invalid choice. Please run the script again and select '32' or '64'.")
                     sys.exit(1)
 
                 print(f"Installing {arch_choice}-bit Azure CLI... (may take up to 5 min)")
                 install_azure_cli_windows(arch_choice)
+                is_az_installed_windows.cache_clear()
 
                 # After installation, attempt to login
-                if is_az_installed_windows():
+                if is_az_installed_windows() and verify_az_functional():
                     login_to_azure_windows()
                 else:
                     print("[ERROR] Azure CLI did not install correctly. Exiting.")
@@ -216,17 +264,19 @@ def main():
         # Linux path
         if is_az_installed():
             print("Azure CLI is already installed on this Linux system.")
-            login_choice = input("Would you like to log in now? [y/n]: ").strip().lower()
+            login_choice = ask("Would you like to log in now? [y/n]: ")
             if login_choice == "y":
                 login_to_azure()
             else:
                 print("Login skipped.")
+                cache_arm_token()
         else:
             print("Azure CLI is not installed on this Linux system.")
-            choice = input("Would you like to install Azure CLI (Debian/Ubuntu) now? [y/n]: ").strip().lower()
+            choice = ask("Would you like to install Azure CLI (Debian/Ubuntu) now? [y/n]: ")
             if choice == "y":
                 install_azure_cli_linux_deb()
-                if is_az_installed():
+                is_az_installed.cache_clear()
+                if is_az_installed() and verify_az_functional():
                     login_to_azure()
                 else:
                     print("[ERROR] Azure CLI did not install correctly. Exiting.")
@@ -238,17 +288,19 @@ def main():
         # macOS path
         if is_az_installed():
             print("Azure CLI is already installed on this macOS system.")
-            login_choice = input("Would you like to log in now? [y/n]: ").strip().lower()
+            login_choice = ask("Would you like to log in now? [y/n]: ")
             if login_choice == "y":
                 login_to_azure()
             else:
                 print("Login skipped.")
+                cache_arm_token()
         else:
             print("Azure CLI is not installed on this macOS system.")
-            choice = input("Would you like to install Azure CLI (Homebrew) now? [y/n]: ").strip().lower()
+            choice = ask("Would you like to install Azure CLI (Homebrew) now? [y/n]: ")
             if choice == "y":
                 install_azure_cli_macos()
-                if is_az_installed():
+                is_az_installed.cache_clear()
+                if is_az_installed() and verify_az_functional():
                     login_to_azure()
                 else:
                     print("[ERROR] Azure CLI did not install correctly. Exiting.")
@@ -262,5 +314,9 @@ def main():
         print("Please install Azure CLI manually: https://learn.microsoft.com/cli/azure")
         sys.exit(1)
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
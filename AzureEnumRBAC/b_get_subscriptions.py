@@ -2,19 +2,42 @@
 """
 b_get_subscriptions.py
 
-Retrieves all subscriptions accessible by the logged-in Azure user
-and removes user data from the output. Stores them as JSON in
-'output/b_subscriptions.json'.
+Retrieves the subscriptions the cached ARM token can see straight from the ARM
+REST API (no az subprocess), in the same shape 'az account list' produces minus
+the user data, and stores them as JSON in 'output/b_subscriptions.json'.
+
+That token belongs to one tenant (the az CLI's current account), so only that
+tenant's subscriptions (plus any delegated to it) are listed, whereas
+'az account list' shows every tenant the user has logged into. A warning names
+the subscriptions in other tenants that the az profile knows about.
 """
 
 import os
-import json
-import sys
 
 # Adjust import if "helpers.py" is in a different directory
-from helpers import run_az_cli_command
+from helpers import arm_list, load_az_profile, write_json
 
 OUTPUT_FILE = "output/b_subscriptions.json"
+SUBSCRIPTIONS_API_VERSION = "2022-12-01"
+
+def warn_other_tenants(subscriptions):
+    """
+    Warns about subscriptions in the az profile (every tenant logged into) that the
+    listing didn't return, i.e. the ones this single-tenant run will skip.
+    """
+    listed = {sub["id"] for sub in subscriptions}
+    profile_subs = (load_az_profile() or {}).get("subscriptions", [])
+    current = {sub.get("tenantId") for sub in profile_subs if sub.get("isDefault")}
+    skipped = [
+        sub for sub in profile_subs
+        if sub.get("id") and sub["id"] not in listed and sub.get("tenantId") not in current
+    ]
+    if not skipped:
+        return
+    tenants = sorted({sub.get("tenantId") or "unknown" for sub in skipped})
+    print(f"[WARNING] {len(skipped)} subscription(s) from other tenants in your az login are "
+          f"not enumerated (tenants: {', '.join(tenants)}).")
+    print("[WARNING] Run 'az account set --subscription <id>' for one of them and run again to cover its tenant.")
 
 def main():
     # Ensure output directory exists
@@ -22,24 +45,35 @@ def main():
 
     print("[INFO] Retrieving Azure subscriptions...")
 
-    # Call Azure CLI to get all subscriptions
-    subscriptions = run_az_cli_command("az account list --output json")
+    # List all subscriptions with the cached ARM token, keeping the fields
+    # (and names) that 'az account list' would have given the later phases
+    subscriptions = [
+        {
+            "cloudName": "AzureCloud",
+            "id": sub["subscriptionId"],
+            "name": sub.get("displayName"),
+            "state": sub.get("state"),
+            "tenantId": sub.get("tenantId"),
+            "managedByTenants": sub.get("managedByTenants", [])
+        }
+        for sub in arm_list("/subscriptions", SUBSCRIPTIONS_API_VERSION)
+    ]
 
     if not subscriptions:
         print("[WARNING] No subscriptions found or user not logged in.")
         # Optionally exit or write an empty file:
         # sys.exit(1)
 
-    # Remove 'user' field from each subscription dict
-    for sub in subscriptions:
-        if "user" in sub:
-            del sub["user"]
+    warn_other_tenants(subscriptions)
 
     # Write results to JSON file
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(subscriptions, f, indent=2)
+    write_json(OUTPUT_FILE, subscriptions)
 
     print(f"[INFO] Subscriptions have been written to {OUTPUT_FILE}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -8,6 +8,9 @@ and resources in each subscription. Outputs a detailed JSON file per subscriptio
 with total resource count, resource group count, and for each resource group,
 a list of resource IDs only.
 
+The ARM list requests for all subscriptions run concurrently on a thread pool;
+files are written on the main thread as each subscription's results come in.
+
 A single TQDM progress bar is used to track progress across all subscriptions,
 and no output is printed while the bar is running, to avoid breaking the progress display.
 """
@@ -15,16 +18,92 @@ and no output is printed while the bar is running, to avoid breaking the progres
 import json
 import os
 import sys
+import concurrent.futures
 
 from tqdm import tqdm
-from helpers import run_az_cli_command
+from helpers import arm_list, write_json
 
 OUTPUT_DIR = os.path.join("output", "c_resources")
 SUBSCRIPTIONS_FILE = os.path.join("output", "b_subscriptions.json")
 
+# Concurrent ARM list requests (two per subscription).
+MAX_WORKERS = 16
+RESOURCES_API_VERSION = "2021-04-01"
+
 def ensure_output_dir_exists():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+def resource_group_from_id(resource_id):
+    """Returns the resource group name in an ARM resource ID, or None."""
+    # /subscriptions/<sub>/resourceGroups/<rg>/providers/...
+    parts = resource_id.split("/")
+    if len(parts) > 4 and parts[3].lower() == "resourcegroups":
+        return parts[4]
+    return None
+
+def list_all(path):
+    return list(arm_list(path, RESOURCES_API_VERSION))
+
+def list_resource_ids(path):
+    """
+    Streams a resource listing page by page, keeping only each resource's ID
+    (the only field written out) instead of the full resource objects.
+    """
+    return [res["id"] for res in arm_list(path, RESOURCES_API_VERSION)]
+
+def write_subscription_resources(sub, rgs_data, resource_ids):
+    """
+    Groups resource_ids by resource group, writes the per-subscription JSON file
+    and returns the summary line to print once the progress bar is done.
+    """
+    sub_id = sub.get("id")
+    sub_name = sub.get("name")
+
+    # Build the output list directly, with a name => entry index on the side
+    rg_list_output = [
+        {
+            "resourceGroupName": rg["name"],
+            "id": rg.get("id"),
+            "location": rg.get("location"),
+            "tags": rg.get("tags", {}),
+            "resourceCount": 0,
+            "resources": []
+        }
+        for rg in rgs_data if rg.get("name")
+    ]
+    rg_by_name = {rg["resourceGroupName"]: rg for rg in rg_list_output}
+
+    # Group resources by RG, storing only resource IDs
+    total_resources = 0
+    for res_id in resource_ids:
+        rg = rg_by_name.get(resource_group_from_id(res_id))
+        if rg is not None:
+            rg["resources"].append(res_id)
+            total_resources += 1
+
+    # Calculate totals
+    for rg in rg_list_output:
+        rg["resourceCount"] = len(rg["resources"])
+    total_rg_count = len(rg_list_output)
+
+    # Final JSON structure for this subscription
+    subscription_output = {
+        "subscriptionId": sub_id,
+        "subscriptionName": sub_name,
+        "resourceGroupCount": total_rg_count,
+        "resourceCount": total_resources,
+        "resourceGroups": rg_list_output
+    }
+
+    # 4. Write out one file per subscription
+    out_filename = f"{sub_id}_resources.json"
+    out_path = os.path.join(OUTPUT_DIR, out_filename)
+    write_json(out_path, subscription_output)
+
+    return (
+        f"Subscription '{sub_name}' ({sub_id}): created file => {out_path} "
+        f"[RGs={total_rg_count}, Resources={total_resources}]"
+    )
 
 def main():
     # Make sure the output directory exists
@@ -44,13 +123,14 @@ def main():
     # We'll store final messages to print AFTER the progress bar completes
     final_messages = []
 
-    # Create a TQDM progress bar for the total number of subscriptions
+    # Submit both list requests for every subscription up front; they are independent
+    # network round-trips, so they overlap well on a thread pool.
     total_subs = len(subscriptions)
-    with tqdm(total=total_subs, desc="Enumerating resources", unit="sub") as pbar:
+    with tqdm(total=total_subs, desc="Enumerating resources", unit="sub") as pbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
         for sub in subscriptions:
             sub_id = sub.get("id")
-            sub_name = sub.get("name")
-
             if not sub_id:
                 # We'll record a warning but not print now
                 final_messages.append("[WARNING] Subscription missing 'id' field. Skipping.")
@@ -58,66 +138,26 @@ def main():
                 continue
 
             # 2. Get all resource groups in this subscription
-            cmd_rg = f"az group list --subscription {sub_id} -o json"
-            rgs_data = run_az_cli_command(cmd_rg)
-
-            # Create a dict of { rgName: {...info..., "resources": []} }
-            resource_groups = {}
-            for rg in rgs_data:
-                rg_name = rg.get("name")
-                if rg_name:
-                    resource_groups[rg_name] = {
-                        "id": rg.get("id"),
-                        "location": rg.get("location"),
-                        "tags": rg.get("tags", {}),
-                        "resources": []
-                    }
+            path_rg = f"/subscriptions/{sub_id}/resourcegroups"
+            futures[executor.submit(list_all, path_rg)] = (sub, "resourceGroups")
 
             # 3. Get all resources in this subscription
-            cmd_res = f"az resource list --subscription {sub_id} -o json"
-            resources_data = run_az_cli_command(cmd_res)
-
-            # Group resources by RG, storing only resource IDs
-            for res in resources_data:
-                rg_name = res.get("resourceGroup")
-                if rg_name and rg_name in resource_groups:
-                    resource_groups[rg_name]["resources"].append(res["id"])
-
-            # Calculate totals
-            total_resources = sum(len(rg_info["resources"]) for rg_info in resource_groups.values())
-            total_rg_count = len(resource_groups)
-
-            # Build a list representation for the JSON output
-            rg_list_output = []
-            for rg_name, rg_info in resource_groups.items():
-                rg_list_output.append({
-                    "resourceGroupName": rg_name,
-                    "id": rg_info["id"],
-                    "location": rg_info["location"],
-                    "tags": rg_info["tags"],
-                    "resourceCount": len(rg_info["resources"]),
-                    "resources": rg_info["resources"]
-                })
-
-            # Final JSON structure for this subscription
-            subscription_output = {
-                "subscriptionId": sub_id,
-                "subscriptionName": sub_name,
-                "resourceGroupCount": total_rg_count,
-                "resourceCount": total_resources,
-                "resourceGroups": rg_list_output
-            }
-
-            # 4. Write out one file per subscription
-            out_filename = f"{sub_id}_resources.json"
-            out_path = os.path.join(OUTPUT_DIR, out_filename)
-            with open(out_path, "w", encoding="utf-8") as f:
-                json.dump(subscription_output, f, indent=2)
-
-            # We'll record a final message for this subscription
+            path_res = f"/subscriptions/{sub_id}/resources"
+            futures[executor.submit(list_resource_ids, path_res)] = (sub, "resources")
+
+        # Results arrive in any order; once both halves of a subscription are in,
+        # build and write its file here on the main thread.
+        results_by_sub = {}
+        for future in concurrent.futures.as_completed(futures):
+            sub, kind = futures[future]
+            results = results_by_sub.setdefault(sub["id"], {})
+            results[kind] = future.result()
+            if len(results) < 2:
+                continue
+
+            del results_by_sub[sub["id"]]
             final_messages.append(
-                f"Subscription '{sub_name}' ({sub_id}): created file => {out_path} "
-                f"[RGs={total_rg_count}, Resources={total_resources}]"
+                write_subscription_resources(sub, results["resourceGroups"], results["resources"])
             )
 
             # Update progress bar by 1 for this subscription
@@ -128,5 +168,9 @@ def main():
     for msg in final_messages:
         print("  " + msg)
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
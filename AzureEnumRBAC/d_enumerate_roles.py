@@ -2,7 +2,8 @@
 """
 d_enumerate_roles.py
 
-Enumerates all Azure role definitions (built-in and custom) and stores them in
+Enumerates all Azure role definitions (built-in and custom, across every
+subscription in output/b_subscriptions.json) and stores them in
 output/d_role_definitions.json.
 
 Usage:
@@ -12,16 +13,20 @@ Usage:
 import os
 import sys
 import json
+import concurrent.futures
 from tqdm import tqdm
 
-from helpers import run_az_cli_command
+from helpers import list_role_definitions, write_json
 
 OUTPUT_DIR = "output"
 OUTPUT_FILE = os.path.join(OUTPUT_DIR, "d_role_definitions.json")
+SUBSCRIPTIONS_FILE = os.path.join(OUTPUT_DIR, "b_subscriptions.json")
+
+# Subscriptions listed at once; each worker has one ARM request in flight at a time.
+MAX_WORKERS = 8
 
 def ensure_output_dir_exists():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def main():
     # Print only before the progress bar
@@ -29,27 +34,43 @@ def main():
 
     ensure_output_dir_exists()
 
-    # Run az CLI to list role definitions
-    cmd = "az role definition list -o json"
+    try:
+        with open(SUBSCRIPTIONS_FILE, "r", encoding="utf-8") as f:
+            subscriptions = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"[ERROR] Failed to read {SUBSCRIPTIONS_FILE}: {e}")
+        sys.exit(1)
+
+    sub_ids = [sub.get("id") for sub in subscriptions if sub.get("id")]
 
+    # List role definitions at each subscription scope, MAX_WORKERS subscriptions at
+    # a time; the single TQDM progress bar tracks the subscriptions as they finish
     try:
-        role_definitions = run_az_cli_command(cmd)
+        with tqdm(total=len(sub_ids), desc="Fetching role definitions", unit="sub") as pbar, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(list_role_definitions, f"/subscriptions/{sub_id}") for sub_id in sub_ids]
+            for _ in concurrent.futures.as_completed(futures):
+                pbar.update(1)
+            # Built-in roles come back for every subscription, so keep one copy of each
+            # definition by name (GUID), taking subscriptions in file order
+            role_definitions = {}
+            for future in futures:
+                for definition in future.result():
+                    role_definitions.setdefault(definition["name"], definition)
     except Exception as e:
         print(f"[ERROR] Failed to enumerate roles: {e}")
         sys.exit(1)
-
-    # Create a single TQDM progress bar once we have the total count
-    with tqdm(total=len(role_definitions), desc="Processing role definitions", unit="def") as pbar:
-        # We don't need to modify the data, just iterate to update progress
-        for _ in role_definitions:
-            pbar.update(1)
+    role_definitions = list(role_definitions.values())
 
     # After the progress bar is finished, write the entire JSON file
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(role_definitions, f, indent=2)
+    write_json(OUTPUT_FILE, role_definitions)
 
     # Print only after the progress bar completes
     print(f"[INFO] Successfully wrote {len(role_definitions)} role definitions to {OUTPUT_FILE}.")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -8,32 +8,100 @@ resource group scope, resource scope) and separates results by principalType
 
 Outputs per subscription in:
   output/e_assignments/<subId>/
-    - users.json
-    - groups.json
-    - serviceprincipals.json
-    - foreigngroups.json
+    - user.jsonl
+    - group.jsonl
+    - serviceprincipal.jsonl
+    - foreigngroup.jsonl
     - etc.
 
+Each file is NDJSON: one assignment object per line, one line per principalId.
+
 Uses a single TQDM progress bar without mid-run prints (only before/after).
 """
 
 import os
+import re
 import sys
 import json
+import functools
+import concurrent.futures
+import requests
 from tqdm import tqdm
 
-from helpers import run_az_cli_command
+from helpers import arm_list, flatten_arm_item, load_json, write_jsonl
 
 SUBSCRIPTIONS_FILE = os.path.join("output", "b_subscriptions.json")
+ROLE_DEFINITIONS_FILE = os.path.join("output", "d_role_definitions.json")
 BASE_OUTPUT_DIR   = os.path.join("output", "e_assignments")
 
+# Subscriptions enumerated at once; each worker has one ARM request in flight at a time.
+MAX_WORKERS = 8
+ROLE_ASSIGNMENTS_API_VERSION = "2022-04-01"
+
+_NON_ALNUM = re.compile(r"[^0-9A-Za-z]+")
+
 def ensure_dir_exists(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
+@functools.lru_cache(maxsize=64)
 def sanitize_filename(s: str) -> str:
     """Make a string safe for filenames by removing/transforming characters as needed."""
-    return "".join(char.lower() for char in s if char.isalnum())
+    return _NON_ALNUM.sub("", s).lower()
+
+def load_role_names():
+    """
+    Returns { role definition GUID (lowercased) => roleName } from d's output. ARM only
+    returns roleDefinitionId on an assignment; the name is resolved from it the way
+    'az role assignment list' does.
+    """
+    return {
+        definition["name"].lower(): definition.get("roleName")
+        for definition in load_json(ROLE_DEFINITIONS_FILE)
+    }
+
+def process_sub(sub_id, role_names):
+    """
+    Fetches all role assignments for one subscription and writes one NDJSON file
+    per principalType, naming each assignment's role from role_names.
+    Returns the number of assignments processed, or None if the subscription was
+    skipped because ARM refused or failed the listing.
+    """
+    scope = f"/subscriptions/{sub_id}"
+    # Build a dict { principalType => list of assignments }
+    assignments_by_type = {}
+    count = 0
+    try:
+        # Every assignment in the subscription, at any scope, page by page
+        path = f"{scope}/providers/Microsoft.Authorization/roleAssignments"
+        for item in arm_list(path, ROLE_ASSIGNMENTS_API_VERSION):
+            ra = flatten_arm_item(item)
+            role_guid = (ra.get("roleDefinitionId") or "").rsplit("/", 1)[-1].lower()
+            ra["roleDefinitionName"] = role_names.get(role_guid)
+
+            p_type = ra.get("principalType", "Unknown") or "Unknown"
+            assignments_by_type.setdefault(p_type, []).append(ra)
+            count += 1
+    except (SystemExit, requests.RequestException):
+        # arm_list exits on an ARM error response (e.g. 403 on this subscription);
+        # skip just this subscription rather than the whole phase
+        return None
+
+    # Write out one NDJSON file per principalType
+    sub_output_dir = os.path.join(BASE_OUTPUT_DIR, sub_id)
+    ensure_dir_exists(sub_output_dir)
+    for p_type, assignments in assignments_by_type.items():
+        # Convert to dict keyed by principalId
+        assignments_dict = {}
+        for assignment in assignments:
+            principal_id = assignment.get("principalId")
+            if principal_id:
+                assignments_dict[principal_id] = assignment
+
+        fname_part = sanitize_filename(p_type)
+        out_file = os.path.join(sub_output_dir, f"{fname_part}.jsonl")
+        write_jsonl(out_file, assignments_dict.values())
+
+    return count
 
 def main():
     # Print only before progress bar starts
@@ -52,58 +120,47 @@ def main():
         print(f"[ERROR] Invalid JSON in: {SUBSCRIPTIONS_FILE}.")
         sys.exit(1)
 
-    # We'll collect the total # of assignments processed across all subscriptions
-    total_assignments = 0
-
-    # Create a TQDM progress bar with initial total=0 (we'll expand it dynamically)
-    with tqdm(total=0, desc="Role Assignments", unit="ra") as pbar:
-        # 2. Loop over each subscription
-        for sub in subscriptions:
-            sub_id = sub.get("id")
-            if not sub_id:
-                continue
+    # 2. Role names, from the definitions d_enumerate_roles.py already listed
+    try:
+        role_names = load_role_names()
+    except FileNotFoundError:
+        print(f"[ERROR] File not found: {ROLE_DEFINITIONS_FILE}. Did you run d_enumerate_roles.py?")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"[ERROR] Invalid JSON in: {ROLE_DEFINITIONS_FILE}.")
+        sys.exit(1)
 
-            # Run CLI to get role assignments at subscription scope
-            cmd = f"az role assignment list --subscription {sub_id} --all -o json"
-            try:
-                role_assignments = run_az_cli_command(cmd)
-            except Exception as e:
-                # If an error, just skip this subscription
+    # We'll collect the total # of assignments processed across all subscriptions,
+    # and the subscriptions that had to be skipped
+    total_assignments = 0
+    skipped_subs = []
+
+    sub_ids = [sub.get("id") for sub in subscriptions if sub.get("id")]
+
+    # Create a TQDM progress bar with initial total=0 (we'll expand it dynamically).
+    # Subscriptions are fetched and written concurrently; the bar is only touched here.
+    with tqdm(total=0, desc="Role Assignments", unit="ra") as pbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(process_sub, sub_id, role_names): sub_id for sub_id in sub_ids}
+        for future in concurrent.futures.as_completed(futures):
+            count = future.result()
+            if count is None:
+                skipped_subs.append(futures[future])
                 continue
-
-            # Expand the progress bar's total by the count for this subscription
-            pbar.total += len(role_assignments)
-            pbar.refresh()
-
-            # Build a dict { principalType => list of assignments }
-            assignments_by_type = {}
-            for ra in role_assignments:
-                p_type = ra.get("principalType", "Unknown") or "Unknown"
-                assignments_by_type.setdefault(p_type, []).append(ra)
-
-                # Each assignment increments the progress
-                pbar.update(1)
-                total_assignments += 1
-
-            # Write out one JSON file per principalType
-            sub_output_dir = os.path.join(BASE_OUTPUT_DIR, sub_id)
-            ensure_dir_exists(sub_output_dir)
-            for p_type, assignments in assignments_by_type.items():
-                # Convert to dict keyed by principalId
-                assignments_dict = {}
-                for assignment in assignments:
-                    principal_id = assignment.get("principalId")
-                    if principal_id:
-                        assignments_dict[principal_id] = assignment
-
-                fname_part = sanitize_filename(p_type)
-                out_file = os.path.join(sub_output_dir, f"{fname_part}.json")
-                with open(out_file, "w", encoding="utf-8") as f:
-                    json.dump(assignments_dict, f, indent=2)
+            pbar.total += count
+            pbar.update(count)
+            total_assignments += count
 
     # After progress bar is complete
     print(f"[INFO] Finished enumerating role assignments by principalType. "
           f"Total role assignments processed: {total_assignments}")
+    if skipped_subs:
+        print(f"[WARNING] Skipped {len(skipped_subs)} subscription(s) whose role assignments "
+              f"could not be listed: {', '.join(sorted(skipped_subs))}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
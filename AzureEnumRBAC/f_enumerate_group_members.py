@@ -3,106 +3,208 @@
 import os
 import sys
 import json
-import requests
+import time
+import threading
+import concurrent.futures
+from collections import deque
 from tqdm import tqdm
-from helpers import get_msgraph_token
-
-GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+from helpers import (
+    BATCH_MAX_ATTEMPTS, BATCH_RETRY_STATUSES, GRAPH_BASE_URL, GRAPH_POOL_SIZE, GRAPH_TOKEN,
+    batch_retry_after, get_graph_session, iter_jsonl, write_json
+)
 
 OUTPUT_DIR = os.path.join("output", "f_ennumerate_group_members")
 ERROR_LOG = os.path.join(OUTPUT_DIR, "f_members_errors.log")
 
-def log_warning_or_error(msg: str):
-    with open(ERROR_LOG, "a", encoding="utf-8") as ef:
-        ef.write(msg.rstrip() + "\n")
+# Groups expanded concurrently (each worker has at most one Graph request in flight)
+MAX_WORKERS = GRAPH_POOL_SIZE
+# Graph's limit on sub-requests per $batch POST
+BATCH_SIZE = 20
 
-def expand_groups_in_subscription(sub_id, group_ids, access_token):
+# Pooled Graph session shared with the other phases; it sends the current Graph token
+# with every request.
+SESSION = get_graph_session()
 
-    sub_data = {}
+# A Future of the direct members of every group requested so far, keyed by group id
+# and shared by all workers, so a nested group is only ever requested from Graph once
+# per run even when several parents reach it at the same time.
+MEMBER_CACHE = {}
+MEMBER_CACHE_LOCK = threading.Lock()
 
-    with tqdm(total=len(group_ids), desc=f"Groups in {sub_id}", position=1, leave=False) as subbar:
-        for g_id in group_ids:
-            details = get_group_details(g_id, access_token)
-            display_name = details.get("displayName") if details else None
+# Output bucket per "#microsoft.graph.<type>" suffix (lowercased); anything else
+# (service principals, devices, contacts, ...) goes to "others".
+_KIND = {"user": "users", "group": "groups"}
 
-            visited = set()
-            members_agg = expand_group_membership(g_id, access_token, visited)
-            # Convert sets => sorted lists
-            for key in members_agg:
-                members_agg[key] = sorted(members_agg[key])
+def log_warning_or_error(msg: str):
+    with open(ERROR_LOG, "a", encoding="utf-8") as ef:
+        ef.write(msg.rstrip() + "\n")
 
-            sub_data[g_id] = {
-                "displayName": display_name,
-                "members": members_agg
-            }
+def expand_group(g_id):
+    members_agg = expand_group_membership(g_id)
+    # Convert sets => sorted lists
+    for key in members_agg:
+        members_agg[key] = sorted(members_agg[key])
+    return members_agg
 
-            # Each group done => update sub-bar
-            subbar.update(1)
+def expand_groups(group_ids):
+    """
+    Expands every group in group_ids (distinct across the whole tenant) once.
+    Returns { group_id: {"displayName": ..., "members": {...}} }.
+    """
 
-    return sub_data
+    members = {}
+    details_cache = {}
 
-def expand_group_membership(group_id, access_token, visited):
+    # Redraw at most once a second; the bar advances once per expanded group
+    with tqdm(total=len(group_ids), desc="Groups", unit="group", mininterval=1.0, smoothing=0) as groupbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Display names arrive BATCH_SIZE groups per request, alongside the expansions
+        detail_futures = [
+            executor.submit(get_group_display_names, group_ids[i:i + BATCH_SIZE])
+            for i in range(0, len(group_ids), BATCH_SIZE)
+        ]
+        futures = {executor.submit(expand_group, g_id): g_id for g_id in group_ids}
+        for future in concurrent.futures.as_completed(futures):
+            members[futures[future]] = future.result()
+            # Each group done => update bar
+            groupbar.update(1)
+        for future in detail_futures:
+            details_cache.update(future.result())
 
-    if group_id in visited:
-        return {"users": set(), "groups": set(), "others": set()}
-    visited.add(group_id)
+    return {
+        g_id: {
+            "displayName": details_cache.get(g_id),
+            "members": members[g_id]
+        }
+        for g_id in group_ids
+    }
 
-    headers = {"Authorization": f"Bearer {access_token}"}
-    aggregated = {"users": set(), "groups": set(), "others": set()}
+def fetch_direct_members(group_id):
+    """
+    Returns the direct members of group_id as a list of (bucket, id) tuples, where
+    bucket is "users", "groups" or "others". The first request for a group pages
+    through Graph; every later request for it (from any parent, subscription or
+    worker) waits for and shares that result via MEMBER_CACHE.
+    """
+    with MEMBER_CACHE_LOCK:
+        future = MEMBER_CACHE.get(group_id)
+        owner = future is None
+        if owner:
+            future = MEMBER_CACHE[group_id] = concurrent.futures.Future()
+    if owner:
+        try:
+            future.set_result(page_direct_members(group_id))
+        except BaseException as ex:
+            # Don't leave the other workers waiting on this group forever
+            future.set_exception(ex)
+            raise
+    return future.result()
 
-    url = f"{GRAPH_BASE_URL}/groups/{group_id}/members?$top=999"
+def page_direct_members(group_id):
+    """Pages through Graph for group_id's direct members; see fetch_direct_members."""
+    members = []
+
+    # Only the id (plus the always-present @odata.type) is used downstream
+    url = f"{GRAPH_BASE_URL}/groups/{group_id}/members?$top=999&$select=id"
     while url:
         try:
-            resp = requests.get(url, headers=headers)
+            resp = SESSION.get(url, timeout=30)
         except Exception as ex:
             log_warning_or_error(f"[ERROR] Exception fetching members of {group_id}: {ex}")
-            return aggregated
+            break
         if not resp.ok:
             log_warning_or_error(f"[WARN] Could not fetch members of {group_id}: {resp.status_code} {resp.text}")
-            return aggregated
+            break
 
         data = resp.json()
-        members = data.get("value", [])
-        for m in members:
-            odata_type = m.get("@odata.type", "").lower()
-            m_id = m.get("id", "")
-            if "user" in odata_type:
-                aggregated["users"].add(m_id)
-            elif "group" in odata_type:
-                aggregated["groups"].add(m_id)
-                # recursively expand
-                nested = expand_group_membership(m_id, access_token, visited)
-                aggregated["users"].update(nested["users"])
-                aggregated["groups"].update(nested["groups"])
-                aggregated["others"].update(nested["others"])
-            else:
-                aggregated["others"].add(m_id)
-
+        for m in data.get("value", []):
+            kind = m.get("@odata.type", "").rsplit(".", 1)[-1].lower()
+            members.append((_KIND.get(kind, "others"), m.get("id", "")))
         url = data.get("@odata.nextLink")
+
+    return members
+
+def expand_group_membership(group_id):
+    """
+    Breadth-first expansion of group_id's transitive membership.
+    Returns {"users": set, "groups": set, "others": set} of member IDs.
+    """
+    aggregated = {"users": set(), "groups": set(), "others": set()}
+    visited = {group_id}
+    pending = deque([group_id])
+
+    while pending:
+        for bucket, m_id in fetch_direct_members(pending.popleft()):
+            aggregated[bucket].add(m_id)
+            if bucket == "groups" and m_id not in visited:
+                visited.add(m_id)
+                pending.append(m_id)
+
     return aggregated
 
-def get_group_details(group_id, access_token):
-    url = f"{GRAPH_BASE_URL}/groups/{group_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    try:
-        resp = requests.get(url, headers=headers)
-    except Exception as ex:
-        log_warning_or_error(f"[ERROR] get_group_details for {group_id}: {ex}")
-        return None
-    if resp.ok:
-        return resp.json()
-    else:
-        log_warning_or_error(f"[WARN] Failed to retrieve group {group_id}: {resp.status_code} {resp.text}")
-        return None
+def graph_batch(urls):
+    """
+    Sends up to BATCH_SIZE relative GET urls in a single Graph $batch POST.
+    Returns {index into urls: response body} for the sub-requests that succeeded;
+    failures are logged. Sub-requests Graph throttles (429/503) are sent again after the
+    longest Retry-After they ask for, up to BATCH_MAX_ATTEMPTS times in all.
+    """
+    results = {}
+    pending = list(range(len(urls)))
+    for attempt in range(1, BATCH_MAX_ATTEMPTS + 1):
+        payload = {"requests": [{"id": str(i), "method": "GET", "url": urls[i]} for i in pending]}
+        try:
+            resp = SESSION.post(f"{GRAPH_BASE_URL}/$batch", json=payload, timeout=30)
+        except Exception as ex:
+            log_warning_or_error(f"[ERROR] Exception sending batch of {len(pending)} requests: {ex}")
+            return results
+        if not resp.ok:
+            log_warning_or_error(f"[WARN] Batch request failed: {resp.status_code} {resp.text}")
+            return results
+
+        # A 200 with an unreadable body fails just this batch, not the phase
+        try:
+            sub_responses = [(int(r["id"]), r) for r in resp.json().get("responses", [])]
+        except Exception as ex:
+            log_warning_or_error(f"[WARN] Unreadable batch response for {len(pending)} requests: {ex}")
+            return results
+        answered = {index for index, _ in sub_responses}
+        for index in pending:
+            if index not in answered:
+                log_warning_or_error(f"[WARN] No batch response for {urls[index]}")
+
+        throttled = []
+        wait = 0.0
+        for index, sub_resp in sub_responses:
+            if index not in pending:
+                log_warning_or_error(f"[WARN] Unexpected batch response id {index}")
+                continue
+            status = sub_resp.get("status")
+            if status == 200:
+                results[index] = sub_resp.get("body", {})
+            elif status in BATCH_RETRY_STATUSES and attempt < BATCH_MAX_ATTEMPTS:
+                throttled.append(index)
+                wait = max(wait, batch_retry_after(sub_resp))
+            else:
+                log_warning_or_error(f"[WARN] Failed to retrieve {urls[index]}: {status} {sub_resp.get('body')}")
+        if not throttled:
+            break
+        time.sleep(wait)
+        pending = throttled
+    return results
+
+def get_group_display_names(group_ids):
+    urls = [f"/groups/{g_id}?$select=id,displayName" for g_id in group_ids]
+    return {group_ids[i]: body.get("displayName") for i, body in graph_batch(urls).items()}
 
 def main():
-    print("[INFO] Starting membership expansions with nested progress bars...")
+    print("[INFO] Starting tenant-wide group membership expansions...")
 
     # Prepare output + error log
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     # Clear error log
     with open(ERROR_LOG, "w", encoding="utf-8") as ef:
-        ef.write("Nested TQDM phase errors/warnings:\n")
+        ef.write("Group membership phase errors/warnings:\n")
 
     # load subscriptions
     subs_file = os.path.join("output", "b_subscriptions.json")
@@ -118,9 +220,9 @@ def main():
             ef.write(f"[ERROR] Failed reading subs: {e}\n")
         sys.exit(1)
 
-    # attempt to get graph token
+    # attempt to get graph token up front, so a login problem stops the run here
     try:
-        access_token = get_msgraph_token()
+        GRAPH_TOKEN.get()
     except Exception as e:
         with open(ERROR_LOG, "a", encoding="utf-8") as ef:
             ef.write(f"[ERROR] get_msgraph_token: {e}\n")
@@ -128,49 +230,46 @@ def main():
 
     base_assign_dir = os.path.join("output", "e_assignments")
 
-    # We'll gather how many subscriptions have group assignments
-    # so we can create a main bar with that many steps
+    # We'll gather which subscriptions have group assignments
     sub_with_groups = []
     for sub in subs:
         sub_id = sub.get("id")
         if not sub_id:
             continue
-        g_file = os.path.join(base_assign_dir, sub_id, "group.json")
+        g_file = os.path.join(base_assign_dir, sub_id, "group.jsonl")
         if os.path.exists(g_file):
             sub_with_groups.append(sub_id)
 
-    # main bar => # of subscriptions that have group.json
-    with tqdm(total=len(sub_with_groups), desc="Subscriptions", unit="sub") as mainbar:
-        for sub_id in sub_with_groups:
-            # read group assignments
-            path = os.path.join(base_assign_dir, sub_id, "group.json")
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    group_data = json.load(f)
-            except Exception as ex:
-                log_warning_or_error(f"[ERROR] read {path}: {ex}")
-                # update main bar even if skip
-                mainbar.update(1)
-                continue
-
-            # group_data => { group_id => { "roleDefinitionName":..., ...}, ... }
-            group_ids = list(group_data.keys())
+    # read every subscription's group assignments up front
+    group_ids_by_sub = {}
+    for sub_id in sub_with_groups:
+        path = os.path.join(base_assign_dir, sub_id, "group.jsonl")
+        try:
+            # one assignment per line => { "principalId": group_id, "roleDefinitionName":..., ...}
+            group_ids_by_sub[sub_id] = [rec["principalId"] for rec in iter_jsonl(path)]
+        except Exception as ex:
+            log_warning_or_error(f"[ERROR] read {path}: {ex}")
 
-            # expand groups in this subscription
-            sub_result = expand_groups_in_subscription(sub_id, group_ids, access_token)
+    # Groups assigned in several subscriptions are expanded only once
+    all_group_ids = list(dict.fromkeys(
+        g_id for group_ids in group_ids_by_sub.values() for g_id in group_ids
+    ))
+    expanded = expand_groups(all_group_ids)
 
-            # write subscription output
-            out_file = os.path.join(OUTPUT_DIR, f"{sub_id}_group_members.json")
-            try:
-                with open(out_file, "w", encoding="utf-8") as f:
-                    json.dump(sub_result, f, indent=2)
-            except Exception as ex:
-                log_warning_or_error(f"[ERROR] writing {out_file}: {ex}")
+    # Each subscription's output is a view over the tenant-wide expansions
+    for sub_id, group_ids in tqdm(group_ids_by_sub.items(), desc="Subscriptions", unit="sub"):
+        sub_result = {g_id: expanded[g_id] for g_id in group_ids}
+        out_file = os.path.join(OUTPUT_DIR, f"{sub_id}_group_members.json")
+        try:
+            write_json(out_file, sub_result)
+        except Exception as ex:
+            log_warning_or_error(f"[ERROR] writing {out_file}: {ex}")
 
-            # done this subscription => main bar update
-            mainbar.update(1)
+    print("[INFO] Group membership expansions complete. See error log for any issues.")
 
-    print("[INFO] Nested progress expansions complete. See error log for any issues.")
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
+    main()
 
 if __name__ == "__main__":
-    main()
+    run()
@@ -4,9 +4,9 @@ g_combine_rbac_users.py
 
 This script combines RBAC assignments for users from multiple sources:
   - User assignments from:
-      output/e_assignments/<subscriptionID>/user.json
+      output/e_assignments/<subscriptionID>/user.jsonl
   - Group assignments: For groups assigned roles in
-      output/e_assignments/<subscriptionID>/group.json,
+      output/e_assignments/<subscriptionID>/group.jsonl,
     the script looks up the expanded membership from:
       output/f_ennumerate_group_members/<subscriptionID>_group_members.json
     and applies the group's role assignment to every user member.
@@ -39,98 +39,84 @@ Output is written to:
 import os
 import sys
 import json
+import multiprocessing
+import concurrent.futures
+from collections import Counter, defaultdict
 
-def get_resource_count_for_scope(scope, sub_id, resource_lookup):
+from helpers import iter_json_object, iter_jsonl, write_json
+
+def add_assignment(combined, principal_id, role, scope, sub_id, sub_scope, resource_lookup):
     """
-    Given a scope string, subscription ID, and a resource lookup dictionary,
-    return the resource count for that scope.
-    
-    - If scope is "/" or equals "/subscriptions/<sub_id>" (case-insensitively),
-      return the total resource count.
-    - Otherwise, if scope is found in resource_lookup["rg"], return that count;
+    Adds an assignment to the combined dictionary (a defaultdict of defaultdicts of Counters).
+    Grouping is done as:
+       combined[principal_id][role][ "<subscription>:<scope>" ]
+    where the value is the aggregated resource count for the scope:
+
+    - If scope is "/" or equals sub_scope ("/subscriptions/<sub_id>", lowercased),
+      the total resource count (case-insensitively).
+    - Otherwise, if the lowercased scope is found in resource_lookup["rg"], that count;
     - Otherwise, assume it represents an individual resource (count = 1).
     """
     if not resource_lookup:
-        return 1
-    sub_scope = f"/subscriptions/{sub_id}".lower()
-    if scope.strip() == "/" or scope.lower() == sub_scope:
-        return resource_lookup.get("total", 0)
+        resource_count = 1
     else:
-        rg_counts = resource_lookup.get("rg", {})
-        return rg_counts.get(scope, 1)
+        scope_lc = scope.lower()
+        if scope_lc == "/" or scope_lc == sub_scope:
+            resource_count = resource_lookup.get("total", 0)
+        else:
+            resource_count = resource_lookup.get("rg", {}).get(scope_lc, 1)
+    combined[principal_id][role][f"{sub_id}:{scope}"] += resource_count
 
-def add_assignment(combined, principal_id, role, scope, sub_id, resource_lookup):
-    """
-    Adds an assignment to the combined dictionary.
-    Grouping is done as:
-       combined[principal_id][role][ "<subscription>:<scope>" ]
-    where the value is the aggregated resource count.
-    """
-    resource_count = get_resource_count_for_scope(scope, sub_id, resource_lookup)
-    leaf_key = f"{sub_id}:{scope}"
-    if principal_id not in combined:
-        combined[principal_id] = {}
-    if role not in combined[principal_id]:
-        combined[principal_id][role] = {}
-    if leaf_key not in combined[principal_id][role]:
-        combined[principal_id][role][leaf_key] = 0
-    combined[principal_id][role][leaf_key] += resource_count
-
-def process_user_assignments(sub_id, combined, resource_lookup):
+def process_user_assignments(sub_id, combined, resource_lookup, sub_scope):
     """
     Processes the user assignments from:
-       output/e_assignments/<subscriptionID>/user.json
+       output/e_assignments/<subscriptionID>/user.jsonl
     """
-    user_file = os.path.join("output", "e_assignments", sub_id, "user.json")
+    user_file = os.path.join("output", "e_assignments", sub_id, "user.jsonl")
     if not os.path.exists(user_file):
         return
     try:
-        with open(user_file, "r", encoding="utf-8") as f:
-            user_assignments = json.load(f)
+        for assignment in iter_jsonl(user_file):
+            principal_id = assignment.get("principalId")
+            role = assignment.get("roleDefinitionName")
+            scope = assignment.get("scope")
+            add_assignment(combined, principal_id, role, scope, sub_id, sub_scope, resource_lookup)
     except Exception as e:
         print(f"[ERROR] Failed to load {user_file}: {e}")
-        return
-    for assignment in user_assignments.values():
-        principal_id = assignment.get("principalId")
-        role = assignment.get("roleDefinitionName")
-        scope = assignment.get("scope")
-        add_assignment(combined, principal_id, role, scope, sub_id, resource_lookup)
 
-def process_group_assignments(sub_id, combined, resource_lookup):
+def process_group_assignments(sub_id, combined, resource_lookup, sub_scope):
     """
     Processes group assignments by combining data from:
-       output/e_assignments/<subscriptionID>/group.json
+       output/e_assignments/<subscriptionID>/group.jsonl
     and
        output/f_ennumerate_group_members/<subscriptionID>_group_members.json
 
     For each group assignment, each user in the expanded membership gets the
     group's roleDefinitionName and scope.
     """
-    group_file = os.path.join("output", "e_assignments", sub_id, "group.json")
+    group_file = os.path.join("output", "e_assignments", sub_id, "group.jsonl")
     group_members_file = os.path.join("output", "f_ennumerate_group_members", f"{sub_id}_group_members.json")
     if not os.path.exists(group_file) or not os.path.exists(group_members_file):
         return
+    # Only the user members are needed, so nested group/other ids are dropped as the file streams in.
     try:
-        with open(group_file, "r", encoding="utf-8") as f:
-            group_assignments = json.load(f)
+        group_users = {
+            group_id: info.get("members", {}).get("users", [])
+            for group_id, info in iter_json_object(group_members_file)
+        }
     except Exception as e:
-        print(f"[ERROR] Failed to load {group_file}: {e}")
+        print(f"[ERROR] Failed to load {group_members_file}: {e}")
         return
     try:
-        with open(group_members_file, "r", encoding="utf-8") as f:
-            group_members = json.load(f)
+        for assignment in iter_jsonl(group_file):
+            group_id = assignment.get("principalId")
+            role = assignment.get("roleDefinitionName")
+            scope = assignment.get("scope")
+            # For each group assignment, apply its role/scope to every user in the expanded membership.
+            for user in group_users.get(group_id, []):
+                add_assignment(combined, user, role, scope, sub_id, sub_scope, resource_lookup)
     except Exception as e:
-        print(f"[ERROR] Failed to load {group_members_file}: {e}")
-        return
-    for group_id, assignment in group_assignments.items():
-        role = assignment.get("roleDefinitionName")
-        scope = assignment.get("scope")
-        # For each group assignment, apply its role/scope to every user in the expanded membership.
-        if group_id in group_members:
-            members_info = group_members[group_id].get("members", {})
-            users = members_info.get("users", [])
-            for user in users:
-                add_assignment(combined, user, role, scope, sub_id, resource_lookup)
+        print(f"[ERROR] Failed to load {group_file}: {e}")
 
 def load_resource_lookup(sub_id):
     """
@@ -139,7 +125,7 @@ def load_resource_lookup(sub_id):
     and build a lookup dictionary:
        {
          "total": <total resource count>,
-         "rg": { <resourceGroupID>: <resourceCount>, ... }
+         "rg": { <lowercased resourceGroupID>: <resourceCount>, ... }
        }
     If the file does not exist or cannot be parsed, returns an empty dict.
     """
@@ -158,10 +144,29 @@ def load_resource_lookup(sub_id):
     for rg in data.get("resourceGroups", []):
         rg_id = rg.get("id")
         if rg_id:
-            rg_lookup[rg_id] = rg.get("resourceCount", 0)
+            rg_lookup[rg_id.lower()] = rg.get("resourceCount", 0)
     lookup["rg"] = rg_lookup
     return lookup
 
+def build_partial(plan_entry):
+    """
+    Aggregates one subscription's user and group assignments on their own, as
+    { principal_id: { role: Counter({ "<subscription>:<scope>": count }) } }.
+    Runs in a worker process, so the result is returned as plain (picklable) dicts.
+    """
+    sub_id, resource_lookup, sub_scope_lc = plan_entry
+    partial = defaultdict(lambda: defaultdict(Counter))
+    process_user_assignments(sub_id, partial, resource_lookup, sub_scope_lc)
+    process_group_assignments(sub_id, partial, resource_lookup, sub_scope_lc)
+    # (ServicePrincipal assignments are not processed in this RBAC user combination.)
+    return sub_id, {principal_id: dict(roles) for principal_id, roles in partial.items()}
+
+def merge_into(combined, partial):
+    """Adds a build_partial result into combined, one Counter.update per (principal, role)."""
+    for principal_id, roles in partial.items():
+        for role, leaves in roles.items():
+            combined[principal_id][role].update(leaves)
+
 def transform_structure(combined):
     """
     Transforms the combined structure into a new nested structure where
@@ -210,7 +215,7 @@ def transform_structure(combined):
 def main():
     output_dir = "output"
     os.makedirs(output_dir, exist_ok=True)
-    combined = {}
+    combined = defaultdict(lambda: defaultdict(Counter))
 
     # Load subscriptions from output/b_subscriptions.json.
     subscriptions_file = os.path.join("output", "b_subscriptions.json")
@@ -224,16 +229,22 @@ def main():
         print(f"[ERROR] Failed to load subscriptions: {e}")
         sys.exit(1)
 
-    # Process assignments for each subscription.
-    for sub in subscriptions:
-        sub_id = sub.get("id")
-        if not sub_id:
-            continue
-        print(f"[INFO] Processing subscription {sub_id} ...")
-        resource_lookup = load_resource_lookup(sub_id)
-        process_user_assignments(sub_id, combined, resource_lookup)
-        process_group_assignments(sub_id, combined, resource_lookup)
-        # (ServicePrincipal assignments are not processed in this RBAC user combination.)
+    # Plan the work once: (sub_id, resource lookup, lowercased subscription scope).
+    plan = [
+        (sub["id"], load_resource_lookup(sub["id"]), f"/subscriptions/{sub['id']}".lower())
+        for sub in subscriptions if sub.get("id")
+    ]
+
+    # Subscriptions are independent and the aggregation is CPU-bound, so each one is
+    # built in its own process and merged here in plan order (keeping the output order).
+    # "spawn" because the orchestrator may be running other phases on threads.
+    # Every input file is streamed exactly once.
+    workers = max(1, min(len(plan), os.cpu_count() or 1))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for sub_id, partial in executor.map(build_partial, plan):
+            print(f"[INFO] Processed subscription {sub_id}")
+            merge_into(combined, partial)
     
     # Transform the combined structure to include counts in the key names,
     # and adjust leaf-level entries as desired.
@@ -242,11 +253,14 @@ def main():
     # Write the transformed output.
     output_file = os.path.join(output_dir, "g_combined_rbac_users.json")
     try:
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(transformed, f, indent=2)
+        write_json(output_file, transformed)
         print(f"[INFO] Combined RBAC users written to {output_file}")
     except Exception as e:
         print(f"[ERROR] Failed to write output: {e}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -4,14 +4,20 @@ h_get_user_personal_data.py
 
 This script reads the combined RBAC users file (g_combined_rbac_users.json) to obtain all user principal IDs
 (which may be bracketed, e.g. "[12]00000000-aaaa-bbbb-cccc-ffffffffffff"). It extracts the real ID and then
-uses multithreading in batches of 100 to query Microsoft Graph for each user's personal data.
+uses a single thread pool to query Microsoft Graph for each user's personal data,
+20 users per Graph $batch request.
 
 A TQDM progress bar is displayed to show how many users are processed. No prints occur during
 progress bar updates. All diagnostic messages (warnings, batch info, etc.) are collected and
 displayed after the progress bar completes.
 
 Output:
-    output/h_user_personal_data.json
+    output/h_user_personal_data.jsonl
+        One {"id": <user ID>, "data": <Graph user object>} record per line, appended as
+        each batch completes; users already in the file are skipped on a re-run.
+    output/h_processed_ids.txt
+        The IDs of the users in h_user_personal_data.jsonl, one per line, which is all a
+        re-run reads to find them.
 
 Prerequisites:
     - g_combined_rbac_users.json must exist in the output folder.
@@ -21,65 +27,157 @@ Prerequisites:
 import os
 import sys
 import json
-import requests
+import time
 import concurrent.futures
 from tqdm import tqdm
 
 # Adjust import if "helpers.py" is in a different directory
-from helpers import get_msgraph_token
+from helpers import (
+    BATCH_MAX_ATTEMPTS, BATCH_RETRY_STATUSES, GRAPH_BASE_URL, GRAPH_POOL_SIZE, GRAPH_TOKEN,
+    batch_retry_after, extract_id_from_bracketed_key, get_graph_session, json_line, load_json
+)
 
-GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+# Graph's limit on sub-requests per $batch POST
+BATCH_SIZE = 20
+# The profile fields the later phases read (i_combine_identities); Graph omits the rest
+USER_FIELDS = "id,userPrincipalName,givenName,surname,displayName,mail,jobTitle,mobilePhone,businessPhones"
+# $batch requests in flight at once (one per worker thread, one pooled connection each)
+MAX_WORKERS = GRAPH_POOL_SIZE
+# Flush the output after roughly this many users, so an interrupted run resumes from there
+CHECKPOINT_USERS = 500
+# Minimum seconds between progress bar redraws (it advances once per $batch)
+PROGRESS_INTERVAL = 1.0
 
-def extract_id_from_bracketed_key(key: str) -> str:
-    """
-    Given a bracketed key like "[12]00000000-aaaa-bbbb-cccc-ffffffffffff",
-    return the substring after the first ']' (i.e. "00000000-aaaa-bbbb-cccc-ffffffffffff").
-    If there is no ']' present, return the original string.
-    """
-    idx = key.find(']')
-    if idx != -1:
-        return key[idx+1:]
-    return key
+# Pooled Graph session shared with the other phases; it retries throttled requests and
+# sends the current Graph token (refreshed shortly before it expires) with each one.
+SESSION = get_graph_session()
 
-def get_user_data(user_id, token):
+def get_user_batch(user_ids):
     """
-    Queries Microsoft Graph API for the user with the given user_id.
-    Returns a tuple (user_id, data, warning_msg).
+    Queries Microsoft Graph for up to BATCH_SIZE users in a single $batch request.
+    Sub-requests Graph throttles (429/503) are sent again after the longest Retry-After
+    they ask for, up to BATCH_MAX_ATTEMPTS times in all.
+    Returns a list of (user_id, data, warning_msg) tuples, one per user:
        - user_id: the user we're querying
-       - data: the JSON response from Graph if successful, else None
+       - data: the user's JSON from Graph if successful, else None
        - warning_msg: any warning string if something failed, else None
     """
-    url = f"{GRAPH_BASE_URL}/users/{user_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            return (user_id, response.json(), None)
-        else:
-            w = f"Failed to fetch data for user {user_id}: {response.status_code} {response.text}"
-            return (user_id, None, w)
-    except Exception as e:
-        w = f"Exception for user {user_id}: {e}"
-        return (user_id, None, w)
+    results = []
+    pending = list(user_ids)
+    for attempt in range(1, BATCH_MAX_ATTEMPTS + 1):
+        payload = {
+            "requests": [
+                {"id": str(i), "method": "GET", "url": f"/users/{user_id}?$select={USER_FIELDS}"}
+                for i, user_id in enumerate(pending)
+            ]
+        }
+        try:
+            response = SESSION.post(
+                f"{GRAPH_BASE_URL}/$batch",
+                json=payload,
+                timeout=30
+            )
+        except Exception as e:
+            results.extend((user_id, None, f"Exception for user {user_id}: {e}") for user_id in pending)
+            return results
+        if response.status_code != 200:
+            results.extend((user_id, None, f"Failed to fetch data for user {user_id}: {response.status_code} {response.text}")
+                           for user_id in pending)
+            return results
 
-def load_existing_output(output_file):
-    """
-    If the output file exists, load and return its contents as a dict;
-    otherwise, return an empty dict.
-    """
-    if os.path.exists(output_file):
+        # A 200 with an unreadable body fails just this batch's users, not the phase
         try:
-            with open(output_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return data
+            sub_responses = [(pending[int(r["id"])], r) for r in response.json().get("responses", [])]
         except Exception as e:
-            # Return empty if it fails, but keep a note
-            return {}
-    return {}
+            results.extend((user_id, None, f"Unreadable $batch response for user {user_id}: {e}")
+                           for user_id in pending)
+            return results
+        answered = {user_id for user_id, _ in sub_responses}
+        results.extend((user_id, None, f"No $batch response for user {user_id}")
+                       for user_id in pending if user_id not in answered)
+
+        throttled = []
+        wait = 0.0
+        for user_id, sub_response in sub_responses:
+            status = sub_response.get("status")
+            if status == 200:
+                results.append((user_id, sub_response.get("body"), None))
+            elif status in BATCH_RETRY_STATUSES and attempt < BATCH_MAX_ATTEMPTS:
+                throttled.append(user_id)
+                wait = max(wait, batch_retry_after(sub_response))
+            else:
+                w = f"Failed to fetch data for user {user_id}: {status} {sub_response.get('body')}"
+                results.append((user_id, None, w))
+        if not throttled:
+            break
+        time.sleep(wait)
+        pending = throttled
+    return results
+
+def truncate_partial_line(path):
+    """Cuts off a trailing line left incomplete (no newline) by an interrupted run."""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        # Walk back a block at a time to the last newline (usually in the final block)
+        while pos > 0:
+            start = max(0, pos - 64 * 1024)
+            f.seek(start)
+            idx = f.read(pos - start).rfind(b"\n")
+            if idx != -1:
+                pos = start + idx + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+def scan_output_ids(output_file):
+    """
+    Reads output_file line by line and returns the set of user IDs recorded in it,
+    cutting the file off at the first incomplete or unreadable line.
+    """
+    processed_ids = set()
+    valid_end = 0
+    with open(output_file, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                processed_ids.add(json.loads(line)["id"])
+            except (ValueError, KeyError, TypeError):
+                # Not JSON (or not UTF-8), no "id", or not a record object
+                break
+            valid_end += len(line)
+        f.truncate(valid_end)
+    return processed_ids
+
+def load_existing_output(output_file, ids_file):
+    """
+    Returns the set of user IDs already recorded in output_file (empty if it doesn't exist).
+    They come from the ids_file sidecar (one ID per line) without parsing any records;
+    if there is no sidecar (e.g. output from an older version) output_file is scanned
+    instead and the sidecar rebuilt to match it. A trailing record left incomplete by an
+    interrupted run is cut off so new records append cleanly.
+    """
+    if not os.path.exists(output_file):
+        # No records yet, whatever an old sidecar may list
+        processed_ids = set()
+    elif os.path.exists(ids_file):
+        truncate_partial_line(output_file)
+        with open(ids_file, "r", encoding="utf-8") as f:
+            return set(f.read().split())
+    else:
+        processed_ids = scan_output_ids(output_file)
+
+    with open(ids_file, "w", encoding="utf-8") as f:
+        f.writelines(f"{user_id}\n" for user_id in processed_ids)
+    return processed_ids
 
 def main():
     combined_file = os.path.join("output", "g_combined_rbac_users.json")
-    output_file = os.path.join("output", "h_user_personal_data.json")
+    output_file = os.path.join("output", "h_user_personal_data.jsonl")
+    # IDs of the users in output_file, one per line, so a re-run needn't parse the records
+    ids_file = os.path.join("output", "h_processed_ids.txt")
 
     # Ensure the combined file exists
     if not os.path.exists(combined_file):
@@ -88,8 +186,7 @@ def main():
 
     # Load the combined RBAC user data (only need the keys)
     try:
-        with open(combined_file, "r", encoding="utf-8") as f:
-            combined_data = json.load(f)
+        combined_data = load_json(combined_file)
         # Convert bracketed principal keys to real AAD user IDs
         all_user_ids = [extract_id_from_bracketed_key(k) for k in combined_data.keys()]
     except Exception as e:
@@ -97,8 +194,8 @@ def main():
         sys.exit(1)
 
     # Load already processed users so we can skip them if we re-run the script
-    user_data_dict = load_existing_output(output_file)
-    processed_ids = set(user_data_dict.keys())
+    processed_ids = load_existing_output(output_file, ids_file)
+    record_count = len(processed_ids)
 
     # Filter out users that are already processed
     remaining_user_ids = [uid for uid in all_user_ids if uid not in processed_ids]
@@ -110,9 +207,9 @@ def main():
     print(f"[INFO] Total users: {total_users}. Already processed: {len(processed_ids)}. "
           f"Remaining: {remaining_count}.")
 
-    # Get a valid Microsoft Graph access token
+    # Get a valid Microsoft Graph access token up front, so a login problem stops the run here
     try:
-        token = get_msgraph_token()
+        GRAPH_TOKEN.get()
     except Exception as e:
         print(f"[ERROR] Failed to get MS Graph token: {e}")
         sys.exit(1)
@@ -120,38 +217,54 @@ def main():
     # We'll collect warnings in a list, to print them after the progress bar finishes
     warnings = []
 
-    # Process users in batches of 100
-    batch_size = 100
+    # IDs of the records written since the last checkpoint, not yet in ids_file
+    pending_ids = []
+
+    def checkpoint():
+        # Records reach disk before their IDs do, so ids_file never lists a user whose
+        # record could still be lost (No prints here so we don't break the TQDM bar)
+        try:
+            out_f.flush()
+            ids_f.write("".join(f"{user_id}\n" for user_id in pending_ids))
+            ids_f.flush()
+            pending_ids.clear()
+        except Exception as e:
+            warnings.append(f"Failed to update output file at a checkpoint: {e}")
 
     # Create a TQDM progress bar that reflects how many users remain to process
-    with tqdm(total=remaining_count, desc="Fetching user data", unit="user") as pbar:
-        for i in range(0, remaining_count, batch_size):
-            batch = remaining_user_ids[i : i + batch_size]
-
-            # Use ThreadPoolExecutor to run requests concurrently
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_user = {executor.submit(get_user_data, user_id, token): user_id
-                                  for user_id in batch}
-                for future in concurrent.futures.as_completed(future_to_user):
-                    user_id, data, warn_msg = future.result()
-                    if data is not None:
-                        user_data_dict[user_id] = data
-                    if warn_msg:
-                        warnings.append(warn_msg)
-
-            # Update the output file after each batch
-            # (No prints here so we don't break the TQDM bar)
-            try:
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(user_data_dict, f, indent=2)
-            except Exception as e:
-                warnings.append(f"Failed to update output file after a batch: {e}")
+    with open(output_file, "ab", buffering=64 * 1024) as out_f, \
+            open(ids_file, "a", encoding="utf-8") as ids_f, \
+            tqdm(total=remaining_count, desc="Fetching user data", unit="user",
+                 mininterval=PROGRESS_INTERVAL, miniters=100, smoothing=0) as pbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Every $batch is queued up front; the pool keeps MAX_WORKERS of them in flight
+        futures = {}
+        for i in range(0, remaining_count, BATCH_SIZE):
+            batch = remaining_user_ids[i : i + BATCH_SIZE]
+            futures[executor.submit(get_user_batch, batch)] = len(batch)
+        since_checkpoint = 0
+        for future in concurrent.futures.as_completed(futures):
+            for user_id, data, warn_msg in future.result():
+                if data is not None:
+                    out_f.write(json_line({"id": user_id, "data": data}))
+                    pending_ids.append(user_id)
+                    record_count += 1
+                if warn_msg:
+                    warnings.append(warn_msg)
+
+            # Push records to disk every CHECKPOINT_USERS users so an interrupted run can
+            # resume from there
+            since_checkpoint += futures[future]
+            if since_checkpoint >= CHECKPOINT_USERS:
+                since_checkpoint = 0
+                checkpoint()
+
+            pbar.update(futures[future])
 
-            # Advance progress bar by the batch size (or the actual batch length, which may be less)
-            pbar.update(len(batch))
+        checkpoint()
 
     # After the progress bar is complete, print final info
-    print(f"[INFO] Completed processing all users. Total user records: {len(user_data_dict)}")
+    print(f"[INFO] Completed processing all users. Total user records: {record_count}")
 
     # Print any warnings we accumulated
     if warnings:
@@ -159,5 +272,9 @@ def main():
         for w in warnings:
             print(f"  - {w}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -1,27 +1,424 @@
+import re
 import subprocess
+import shutil
+import base64
 import json
 import sys
+import os
+import time
+import threading
+from datetime import datetime
 
-def run_az_cli_command(command):
+import requests
+import requests.auth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, see the "fast" extra in pyproject.toml
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # optional, see the "fast" extra in pyproject.toml
+    ijson = None
+
+ARM_BASE_URL = "https://management.azure.com"
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+ROLE_DEFINITIONS_API_VERSION = "2022-04-01"
+
+# Cached Azure Resource Manager token, written by a_login_or_install.py after login
+# so later phases don't each have to start the az CLI to get one.
+ARM_TOKEN_FILE = os.path.join("output", "token.json")
+
+# Cached Microsoft Graph tokens, shared by every run on this machine so back-to-back
+# phases (f, h) don't each pay the az CLI's multi-second startup. One file per tenant
+# (see msgraph_token_file), so a run never picks up another login's token.
+MSGRAPH_TOKEN_DIR = os.path.join(os.path.expanduser("~"), ".cache")
+
+# Refresh tokens that expire within this many seconds.
+TOKEN_EXPIRY_MARGIN = 300
+
+# Keep-alive connections held for Graph; the Graph phases run at most this many
+# requests at once.
+GRAPH_POOL_SIZE = 32
+
+# $batch sub-request statuses that mean "throttled, try again later". Graph reports
+# these per sub-request inside a 200 response, so the session's Retry never sees them.
+BATCH_RETRY_STATUSES = (429, 503)
+# Attempts per throttled sub-request before it is reported as failed
+BATCH_MAX_ATTEMPTS = 5
+
+_session = None
+_session_lock = threading.Lock()
+_graph_session = None
+
+def load_json(path):
+    """Reads a whole JSON file, via orjson when it is installed."""
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_json(path, obj):
+    """Writes obj to path as indented JSON, via orjson when it is installed."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2)
+
+def json_line(obj):
+    """Returns obj as one compact, newline-terminated JSON line (bytes), via orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj) + b"\n"
+    return json.dumps(obj).encode("utf-8") + b"\n"
+
+def json_text(obj):
+    """Returns obj as compact JSON text (non-ASCII kept as-is), via orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+def template_pieces(template, values):
+    """
+    Splits template on the markers in values (e.g. {"{data}": "..."}) in one pass and
+    returns the text pieces with each marker replaced by its value, ready for
+    f.writelines() without building the filled page as one big string.
+    """
+    parts = re.split("(" + "|".join(map(re.escape, values)) + ")", template)
+    parts[1::2] = [values[marker] for marker in parts[1::2]]
+    return parts
+
+def write_jsonl(path, records):
+    """Writes each record as one compact JSON line (NDJSON)."""
+    with open(path, "wb") as f:
+        for record in records:
+            f.write(json_line(record))
+
+def iter_jsonl(path):
+    """Yields the records of an NDJSON file one line at a time, skipping blank lines."""
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+def iter_json_object(path):
+    """
+    Yields the (key, value) pairs of the top-level JSON object in path.
+    With ijson installed the file is parsed incrementally, one value at a time.
+    """
+    if ijson is not None:
+        with open(path, "rb") as f:
+            yield from ijson.kvitems(f, "", use_float=True)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f).items()
+
+def extract_id_from_bracketed_key(key):
+    """
+    Given a bracketed key like "[12]00000000-aaaa-bbbb-cccc-ffffffffffff", return the
+    substring after the first ']' (the real principal ID); keys without one are returned as-is.
+    """
+    _, sep, tail = key.partition("]")
+    return tail if sep else key
+
+def parse_bracketed_label(s):
+    """
+    Given "[6]Contributor", return "Contributor" (stripped).
+    Labels without a leading bracketed count are returned as-is.
+    """
+    if not s.startswith("["):
+        return s
+    _, sep, tail = s.partition("]")
+    return tail.strip() if sep else s
+
+def parse_bracketed(s):
+    """
+    Given "[6]Contributor", return (6, "Contributor") from a single partition scan.
+    Keys without a leading bracket give (0, s); a non-numeric count gives 0.
+    """
+    head, sep, tail = s.partition("]")
+    if not sep or not head.startswith("["):
+        return 0, s
+    try:
+        return int(head[1:]), tail.strip()
+    except ValueError:
+        return 0, tail.strip()
+
+def run_az_cli_command(args):
+    """
+    Runs az with the argument list args (no shell) and returns its parsed JSON output.
+    Exits if the command fails or prints something other than JSON.
+    """
+    # On Windows az is az.cmd, which only a shell would otherwise find on PATH
+    command = [shutil.which(args[0]) or args[0], *args[1:]]
+    loads = orjson.loads if orjson is not None else json.loads
     try:
         result = subprocess.run(
             command,
-            shell=True,
             check=True,
             capture_output=True,
             text=True
         )
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Command failed: {command}")
-        print(f"[ERROR] CLI error: {e.stderr}")
+        return loads(result.stdout)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"[ERROR] Command failed: {' '.join(args)}")
+        print(f"[ERROR] CLI error: {getattr(e, 'stderr', None) or e}")
         sys.exit(1)
-    except json.JSONDecodeError as e:
-        print(f"[ERROR] Failed to parse JSON output from command: {command}")
+    except ValueError as e:
+        print(f"[ERROR] Failed to parse JSON output from command: {' '.join(args)}")
         print(f"[ERROR] Output was: {result.stdout}")
         sys.exit(1)
 
-def get_msgraph_token():
-    cmd = "az account get-access-token --resource-type ms-graph -o json"
-    data = run_az_cli_command(cmd)
-    return data["accessToken"]
\ No newline at end of file
+def jwt_exp(token):
+    """Return the exp claim (epoch seconds) of a JWT, without verifying it; None if unreadable."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+class TokenProvider(requests.auth.AuthBase):
+    """
+    Thread-safe holder for a bearer token from fetch() (e.g. get_msgraph_token), fetched
+    on first use and again TOKEN_EXPIRY_MARGIN seconds before the JWT expires, so long
+    runs don't fail with 401s once the original token lapses. Set it as a session's
+    auth to have every request carry the current token.
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self._token = None
+        self._header = None
+        self._exp = 0
+
+    def _refresh_if_due(self):
+        if time.time() > self._exp - TOKEN_EXPIRY_MARGIN:
+            self._token = self._fetch()
+            self._header = f"Bearer {self._token}"
+            # Entra tokens last at least an hour; assume that if exp can't be read
+            self._exp = jwt_exp(self._token) or time.time() + 3600
+
+    def get(self):
+        with self._lock:
+            self._refresh_if_due()
+            return self._token
+
+    def __call__(self, r):
+        # The header string is built once per token, not once per request
+        with self._lock:
+            self._refresh_if_due()
+            r.headers["Authorization"] = self._header
+        return r
+
+def _token_expiry(data):
+    """Return the expiry of an 'az account get-access-token' result as epoch seconds."""
+    if data.get("expires_on"):
+        return int(data["expires_on"])
+    # Older CLI versions only report a local-time "expiresOn" string.
+    return int(datetime.fromisoformat(data["expiresOn"]).timestamp())
+
+def _load_cached_token(path):
+    """Return the access token cached in path if it is still valid, else None."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("expiresAt", 0) - time.time() <= TOKEN_EXPIRY_MARGIN:
+        return None
+    return cached.get("accessToken")
+
+def _write_cached_token(path, data):
+    """
+    Cache an 'az account get-access-token' result in path, readable by the current
+    user only. Written then renamed, so a concurrent reader never sees a half-written
+    cache.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"accessToken": data["accessToken"], "expiresAt": _token_expiry(data)}, f)
+    os.replace(tmp_path, path)
+
+def load_az_profile():
+    """
+    Return the az CLI's azureProfile.json (its logged-in accounts), read straight from
+    disk (no az process), or None if there is no readable profile.
+    """
+    config_dir = os.environ.get("AZURE_CONFIG_DIR") or os.path.join(os.path.expanduser("~"), ".azure")
+    try:
+        # The CLI writes this file with a BOM
+        with open(os.path.join(config_dir, "azureProfile.json"), "r", encoding="utf-8-sig") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def current_tenant_id():
+    """Return the tenant of the az CLI's default account, or None if it can't be read."""
+    for sub in (load_az_profile() or {}).get("subscriptions", []):
+        if sub.get("isDefault"):
+            return sub.get("tenantId")
+    return None
+
+def msgraph_token_file(tenant_id):
+    """Return the path of the cached Graph token for tenant_id."""
+    return os.path.join(MSGRAPH_TOKEN_DIR, f"azureenumrbac_msgraph_{tenant_id}.json")
+
+def load_cached_arm_token():
+    """Return the cached ARM access token if it is still valid, else None."""
+    return _load_cached_token(ARM_TOKEN_FILE)
+
+def get_msgraph_token(force_refresh=False):
+    """
+    Return an access token for Microsoft Graph, reusing the current tenant's
+    msgraph_token_file while it is valid (unless force_refresh) and otherwise asking
+    the logged-in az CLI. Nothing is cached if the tenant can't be determined.
+    """
+    tenant_id = current_tenant_id()
+    path = msgraph_token_file(tenant_id) if tenant_id else None
+    token = None if force_refresh or path is None else _load_cached_token(path)
+    if token:
+        return token
+    data = run_az_cli_command(["az", "account", "get-access-token", "--resource-type", "ms-graph", "-o", "json"])
+    if path is not None:
+        _write_cached_token(path, data)
+    return data["accessToken"]
+
+# Graph token shared by every Graph phase, and the auth of get_graph_session()
+GRAPH_TOKEN = TokenProvider(get_msgraph_token)
+
+def get_arm_token(force_refresh=False):
+    """
+    Return an access token for management.azure.com, reusing ARM_TOKEN_FILE while
+    it is valid (unless force_refresh) and otherwise asking the logged-in az CLI.
+    """
+    token = None if force_refresh else load_cached_arm_token()
+    if token:
+        return token
+    data = run_az_cli_command(
+        ["az", "account", "get-access-token", "--resource", "https://management.azure.com/", "-o", "json"]
+    )
+    _write_cached_token(ARM_TOKEN_FILE, data)
+    return data["accessToken"]
+
+# ARM token shared by every ARM phase, and the auth of get_session()
+ARM_TOKEN = TokenProvider(get_arm_token)
+
+def get_session():
+    """
+    Return a process-wide requests.Session for ARM calls, backed by a connection pool
+    shared across threads. Throttled/failed requests are retried by the adapter,
+    honouring Retry-After, and the last response is handed back instead of raising.
+    Requests are authorized with ARM_TOKEN, refreshed as it nears expiry.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.auth = ARM_TOKEN
+            session.mount("https://", HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=32,
+                max_retries=Retry(
+                    total=5,
+                    backoff_factor=1,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+            ))
+            _session = session
+        return _session
+
+def get_graph_session():
+    """
+    Return a process-wide requests.Session for Microsoft Graph calls. The phases run by
+    the orchestrator (f, h) share its keep-alive connections rather than each doing its
+    own TLS handshakes. Throttled/failed requests are retried by the adapter, honouring
+    Retry-After, and the last response is handed back instead of raising; POST is only
+    used for read-only $batch calls, so it is retried as well. Requests are authorized
+    with GRAPH_TOKEN, refreshed as it nears expiry.
+    """
+    global _graph_session
+    with _session_lock:
+        if _graph_session is None:
+            session = requests.Session()
+            session.auth = GRAPH_TOKEN
+            session.mount("https://", HTTPAdapter(
+                pool_connections=GRAPH_POOL_SIZE,
+                pool_maxsize=GRAPH_POOL_SIZE,
+                max_retries=Retry(
+                    total=5,
+                    backoff_factor=1,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    respect_retry_after_header=True,
+                    allowed_methods=frozenset({"GET", "POST"}),
+                    raise_on_status=False
+                )
+            ))
+            _graph_session = session
+        return _graph_session
+
+def batch_retry_after(sub_response, default=1.0):
+    """
+    Seconds a throttled $batch sub-response asks the caller to wait, from its own
+    Retry-After header (default if it has none).
+    """
+    for name, value in (sub_response.get("headers") or {}).items():
+        if name.lower() == "retry-after":
+            try:
+                return max(0.0, float(value))
+            except (TypeError, ValueError):
+                break
+    return default
+
+def arm_list(path, api_version):
+    """
+    Yield every item of a paged ARM list endpoint (path relative to ARM_BASE_URL),
+    following nextLink. Exits on an error response, like run_az_cli_command.
+    """
+    session = get_session()
+    url = f"{ARM_BASE_URL}{path}"
+    params = {"api-version": api_version}
+    while url:
+        resp = session.get(url, params=params, timeout=60)
+        if not resp.ok:
+            print(f"[ERROR] Request failed: GET {url}")
+            print(f"[ERROR] ARM error: {resp.status_code} {resp.text}")
+            sys.exit(1)
+        data = resp.json()
+        yield from data.get("value", [])
+        # nextLink already carries the api-version and paging token
+        url = data.get("nextLink")
+        params = None
+
+def flatten_arm_item(item):
+    """
+    Merge an ARM item's "properties" into its top level (id/name/type kept), which is
+    the shape the az CLI prints and the later phases read.
+    """
+    flat = {"id": item.get("id"), "name": item.get("name"), "type": item.get("type")}
+    flat.update(item.get("properties", {}))
+    return flat
+
+def list_role_definitions(scope):
+    """
+    Return the role definitions visible at scope as 'az role definition list' prints
+    them: properties flattened, with the role's own type exposed as "roleType".
+    """
+    definitions = []
+    path = f"{scope}/providers/Microsoft.Authorization/roleDefinitions"
+    for item in arm_list(path, ROLE_DEFINITIONS_API_VERSION):
+        properties = dict(item.get("properties", {}))
+        properties["roleType"] = properties.pop("type", None)
+        definitions.append(flatten_arm_item({**item, "properties": properties}))
+    return definitions
@@ -3,7 +3,7 @@
 i_combine_identities.py
 
 Reads two inputs:
-  1) h_user_personal_data.json (keyed by user ID; Graph profile info)
+  1) h_user_personal_data.jsonl (one {"id", "data"} record per user; Graph profile info)
   2) g_combined_rbac_users.json (keyed by bracketed principal IDs, e.g. "[12]xxxx-...")
 
 For each user:
@@ -21,22 +21,47 @@ Any fields whose values are None are omitted entirely, so null values don't appe
 
 import os
 import sys
-import json
 
-INPUT_H_FILE  = os.path.join("output", "h_user_personal_data.json")
+from helpers import extract_id_from_bracketed_key, iter_json_object, iter_jsonl, write_json
+
+INPUT_H_FILE  = os.path.join("output", "h_user_personal_data.jsonl")
 INPUT_G_FILE  = os.path.join("output", "g_combined_rbac_users.json")
 OUTPUT_FILE   = os.path.join("output", "i_combined_user_identities.json")
 
-def extract_id_from_bracketed_key(key: str) -> str:
-    """
-    If the key is something like "[12]00000000-aaaa-bbbb-cccc-ffffffffffff",
-    return the substring after the first ']' (the real user ID).
-    If no bracket is found, return the string as-is.
-    """
-    idx = key.find(']')
-    if idx != -1:
-        return key[idx+1:]
-    return key
+# Profile fields copied as-is into each user entry (when not None)
+FIELDS = ("mail", "displayName", "jobTitle", "mobilePhone")
+
+def user_full_name(details):
+    """The top-level name: "<givenName> <surname>", else displayName, else userPrincipalName."""
+    given_name = (details.get("givenName") or "").strip()
+    surname    = (details.get("surname") or "").strip()
+    return (
+        f"{given_name} {surname}".strip()
+        # fallback
+        or details.get("displayName") or details.get("userPrincipalName") or "(Unknown)"
+    )
+
+def build_user_entry(details, rbac):
+    """A user's entry: the standard fields, businessPhone(s) and rbac, omitting None values."""
+    user_entry = {}
+    for field in FIELDS:
+        val = details.get(field)
+        if val is not None:
+            user_entry[field] = val
+
+    # BusinessPhones logic
+    phone_list = details.get("businessPhones")
+    if phone_list is not None:
+        if len(phone_list) == 1:
+            user_entry["businessPhone"] = phone_list[0]
+        elif len(phone_list) > 1:
+            user_entry["businessPhones"] = phone_list
+        # omit if empty
+
+    # Attach the RBAC data if found
+    if rbac is not None:
+        user_entry["rbac"] = rbac
+    return user_entry
 
 def main():
     # 1. Check for input files
@@ -47,76 +72,43 @@ def main():
         print(f"[ERROR] Expected g-phase file not found: {INPUT_G_FILE}")
         sys.exit(1)
 
-    # 2. Load user data from h_user_personal_data.json
-    try:
-        with open(INPUT_H_FILE, "r", encoding="utf-8") as f:
-            user_data = json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Failed to load {INPUT_H_FILE}: {e}")
-        sys.exit(1)
-
-    # 3. Load and transform g_combined_rbac_users.json
+    # 2. Load and transform g_combined_rbac_users.json
     #    We build a lookup table keyed by the "real" user ID
-    #    (extracted from bracket-laden keys).
-    rbac_data_by_id = {}
+    #    (extracted from bracket-laden keys), streaming the file rather than
+    #    holding a second, bracket-keyed copy of it.
     try:
-        with open(INPUT_G_FILE, "r", encoding="utf-8") as f:
-            rbac_data = json.load(f)
+        rbac_data_by_id = {
+            extract_id_from_bracketed_key(bracketed_key): rbac_object
+            for bracketed_key, rbac_object in iter_json_object(INPUT_G_FILE)
+        }
     except Exception as e:
         print(f"[ERROR] Failed to load {INPUT_G_FILE}: {e}")
         sys.exit(1)
 
-    for bracketed_key, rbac_object in rbac_data.items():
-        real_id = extract_id_from_bracketed_key(bracketed_key)
-        rbac_data_by_id[real_id] = rbac_object
-
-    # 4. Build the combined data structure
+    # 3. Build the combined data structure straight from h_user_personal_data.jsonl,
+    #    one record at a time, so only the trimmed user entries stay in memory
+    #    (not every full Graph profile as well).
     combined_identities = {}
 
-    for user_id, details in user_data.items():
-        # a) Determine the top-level name
-        given_name = details.get("givenName") or ""
-        surname    = details.get("surname") or ""
-        pieces = [n.strip() for n in (given_name, surname) if n.strip()]
-        if pieces:
-            full_name = " ".join(pieces)
-        else:
-            # fallback
-            full_name = details.get("displayName") or details.get("userPrincipalName") or "(Unknown)"
-
-        # b) Prepare user entry with standard fields
-        user_entry = {}
-        for field in ["mail", "displayName", "jobTitle", "mobilePhone"]:
-            val = details.get(field)
-            if val is not None:
-                user_entry[field] = val
-
-        # c) BusinessPhones logic
-        phone_list = details.get("businessPhones")
-        if phone_list is not None:
-            if len(phone_list) == 1:
-                user_entry["businessPhone"] = phone_list[0]
-            elif len(phone_list) > 1:
-                user_entry["businessPhones"] = phone_list
-            # omit if empty
-
-        # d) Attach the RBAC data if found
-        found_rbac = rbac_data_by_id.get(user_id)
-        if found_rbac is not None:
-            user_entry["rbac"] = found_rbac
-
-        # e) Insert into combined structure
-        if full_name not in combined_identities:
-            combined_identities[full_name] = {}
-        combined_identities[full_name][user_id] = user_entry
-
-    # 5. Write out the combined data
     try:
-        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-            json.dump(combined_identities, f, indent=2)
+        for record in iter_jsonl(INPUT_H_FILE):
+            user_id, details = record["id"], record["data"]
+            combined_identities.setdefault(user_full_name(details), {})[user_id] = \
+                build_user_entry(details, rbac_data_by_id.get(user_id))
+    except Exception as e:
+        print(f"[ERROR] Failed to load {INPUT_H_FILE}: {e}")
+        sys.exit(1)
+
+    # 4. Write out the combined data
+    try:
+        write_json(OUTPUT_FILE, combined_identities)
         print(f"[INFO] Successfully wrote combined identities to {OUTPUT_FILE}")
     except Exception as e:
         print(f"[ERROR] Failed to write {OUTPUT_FILE}: {e}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -24,17 +24,51 @@ Defaults:
 
 import os
 import sys
-import json
 import csv
 
-def parse_bracketed_label(s: str) -> str:
+from helpers import iter_json_object, parse_bracketed_label
+
+# Write buffer for the CSV, so large matrices go out in few write syscalls
+CSV_BUFFER_SIZE = 1 << 20
+
+def iter_rows(entries):
     """
-    Given '[6]Contributor', returns 'Contributor'.
-    If no bracket, return s as-is.
+    Yields one (role, name, displayName, jobTitle, principalID, scope) tuple per
+    sub-scope of every role of every principal in entries, the (name, principal_map)
+    pairs of i_combined_user_identities.json:
+    {
+      "User Name": {
+          "PrincipalID": {
+              "displayName": "...",
+              "jobTitle": "...",
+              "rbac": {
+                "[6]Contributor": { "[6]subId": "/subscriptions/...", ... },
+                ...
+              }
+          },
+          ...
+      },
+      ...
+    }
     """
-    if not s.startswith("[") or "]" not in s:
-        return s
-    return s[s.index("]") + 1:].strip()
+    for name, principal_map in entries:
+        for principal_id, details in principal_map.items():
+            display_name = details.get("displayName", "")
+            job_title    = details.get("jobTitle", "")
+            rbac_obj     = details.get("rbac", {})
+
+            if not isinstance(rbac_obj, dict):
+                continue
+
+            # For each bracketed role key
+            for role_key, sub_scopes_dict in rbac_obj.items():
+                role_label = parse_bracketed_label(role_key)
+                if not isinstance(sub_scopes_dict, dict):
+                    continue
+
+                # sub_scopes_dict => { "[xxx]someSubId": "/subscriptions/...", ... }
+                for scope_value in sub_scopes_dict.values():
+                    yield (role_label, name, display_name, job_title, principal_id, scope_value)
 
 def main():
     # Default file paths
@@ -57,76 +91,24 @@ def main():
         print(f"[ERROR] Input file not found: {input_file}")
         sys.exit(1)
 
-    # Load JSON
-    try:
-        with open(input_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Could not read JSON from {input_file}: {e}")
-        sys.exit(1)
-
     # Ensure output directory
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
 
-    # We'll do two passes:
-    # Pass A: gather rows + count how many times each role appears globally.
-    # Pass B: fill 'principle_count' for each row from that global map.
+    # We'll stream the input twice (one user's entry at a time with ijson installed),
+    # without materialising the rows:
+    # Pass A: count how many times each role appears globally.
+    # Pass B: write each row with its role's 'principle_count' from that global map.
 
-    rows = []
+    # ============= PASS A: track role frequency =============
     role_count_map = {}
+    try:
+        for row in iter_rows(iter_json_object(input_file)):
+            role_count_map[row[0]] = role_count_map.get(row[0], 0) + 1
+    except Exception as e:
+        print(f"[ERROR] Could not read JSON from {input_file}: {e}")
+        sys.exit(1)
 
-    # ============= PASS A: build row data + track role frequency =============
-    # data structure:
-    # {
-    #   "User Name": {
-    #       "PrincipalID": {
-    #           "displayName": "...",
-    #           "jobTitle": "...",
-    #           "rbac": {
-    #             "[6]Contributor": { "[6]subId": "/subscriptions/...", ... },
-    #             ...
-    #           }
-    #       },
-    #       ...
-    #   },
-    #   ...
-    # }
-
-    for name, principal_map in data.items():
-        for principal_id, details in principal_map.items():
-            display_name = details.get("displayName", "")
-            job_title    = details.get("jobTitle", "")
-            rbac_obj     = details.get("rbac", {})
-
-            if not isinstance(rbac_obj, dict):
-                continue
-
-            # For each bracketed role key
-            for role_key, sub_scopes_dict in rbac_obj.items():
-                role_label = parse_bracketed_label(role_key)
-                if not isinstance(sub_scopes_dict, dict):
-                    continue
-
-                # sub_scopes_dict => { "[xxx]someSubId": "/subscriptions/...", ... }
-                for _scope_bracket, scope_value in sub_scopes_dict.items():
-                    # increment global role count
-                    role_count_map[role_label] = role_count_map.get(role_label, 0) + 1
-
-                    # store row (we'll fill principle_count later)
-                    rows.append({
-                        "role": role_label,
-                        "name": name,
-                        "displayName": display_name,
-                        "jobTitle": job_title,
-                        "principalID": principal_id,
-                        "scope": scope_value
-                    })
-
-    # ============= PASS B: fill principle_count =============
-    for row in rows:
-        row["principle_count"] = role_count_map[row["role"]]
-
-    # ============= Write CSV =============
+    # ============= PASS B: write CSV with principle_count =============
     fieldnames = [
         "principle_count",
         "role",
@@ -138,25 +120,22 @@ def main():
     ]
 
     try:
-        with open(output_csv, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
+        with open(output_csv, "w", encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
 
             row_count = 0
-            for row in rows:
-                writer.writerow({
-                    "principle_count": row["principle_count"],
-                    "role": row["role"],
-                    "name": row["name"],
-                    "displayName": row["displayName"],
-                    "jobTitle": row["jobTitle"],
-                    "principalID": row["principalID"],
-                    "scope": row["scope"]
-                })
+            for row in iter_rows(iter_json_object(input_file)):
+                # row => (role, name, displayName, jobTitle, principalID, scope)
+                writer.writerow((role_count_map[row[0]], *row))
                 row_count += 1
         print(f"[INFO] Wrote {row_count} rows to {output_csv}")
     except Exception as e:
         print(f"[ERROR] Could not write to {output_csv}: {e}")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -37,10 +37,29 @@ Output:
 """
 
 import os
+import re
 import sys
-import json
 import csv
 import glob
+import concurrent.futures
+
+from helpers import iter_json_object, load_json, parse_bracketed_label
+
+# Threads reading c_resources files at once
+LOAD_WORKERS = 8
+
+# Write buffer for the CSV, so large matrices go out in few write syscalls
+CSV_BUFFER_SIZE = 1 << 20
+
+# "/subscriptions/<subId>" prefix of a scope; group(1) is the subscription id
+SUB_RE = re.compile(r"^/subscriptions/([^/]+)", re.IGNORECASE)
+
+def _load_resources_file(path):
+    """Returns (path, parsed JSON, None), or (path, None, exception) if it can't be read."""
+    try:
+        return path, load_json(path), None
+    except Exception as e:
+        return path, None, e
 
 def load_c_resources(c_resources_dir="output/c_resources"):
     """
@@ -49,12 +68,13 @@ def load_c_resources(c_resources_dir="output/c_resources"):
     """
     sub_map = {}
     path_pattern = os.path.join(c_resources_dir, "*_resources.json")
-    for path in glob.glob(path_pattern):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception as e:
-            print(f"[WARN] Could not parse {path}: {e}")
+    # Read + parse the files concurrently; results still come back in glob order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        loaded = list(executor.map(_load_resources_file, glob.glob(path_pattern)))
+
+    for path, data, error in loaded:
+        if error is not None:
+            print(f"[WARN] Could not parse {path}: {error}")
             continue
 
         sub_id = data.get("subscriptionId")
@@ -80,20 +100,6 @@ def load_c_resources(c_resources_dir="output/c_resources"):
         }
     return sub_map
 
-def parse_bracketed_label(s: str) -> str:
-    """E.g. "[6]Contributor" -> "Contributor". If no bracket, return s as-is."""
-    if not s.startswith("[") or "]" not in s:
-        return s
-    return s[s.index("]")+1:].strip()
-
-def is_subscription_scope(scope: str, sub_id: str) -> bool:
-    """True if scope is "/" or "/subscriptions/<sub_id>" (case-insensitive)."""
-    if not scope or not sub_id:
-        return False
-    s_lower = scope.strip().lower()
-    sub_lower = f"/subscriptions/{sub_id}".lower()
-    return (s_lower == "/" or s_lower == sub_lower)
-
 def main():
     default_i_combined = os.path.join("output", "i_combined_user_identities.json")
     c_resources_dir = os.path.join("output", "c_resources")
@@ -107,18 +113,11 @@ def main():
     # 1) load c_resources
     sub_map = load_c_resources(c_resources_dir)
 
-    # 2) load i_combined_user_identities.json
+    # 2) check i_combined_user_identities.json (streamed one user at a time in step 4)
     if not os.path.exists(i_combined_path):
         print(f"[ERROR] {i_combined_path} not found.")
         sys.exit(1)
 
-    try:
-        with open(i_combined_path, "r", encoding="utf-8") as f:
-            i_data = json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Could not load JSON from {i_combined_path}: {e}")
-        sys.exit(1)
-
     # 3) write CSV
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
     fieldnames = [
@@ -132,111 +131,84 @@ def main():
         "resource_path"
     ]
     try:
-        out_f = open(output_csv, "w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(out_f, fieldnames=fieldnames)
-        writer.writeheader()
+        out_f = open(output_csv, "w", encoding="utf-8", newline="", buffering=CSV_BUFFER_SIZE)
+        writer = csv.writer(out_f)
+        writer.writerow(fieldnames)
     except Exception as e:
         print(f"[ERROR] Could not open {output_csv} for writing: {e}")
         sys.exit(1)
 
     row_count = 0
 
+    # Resource groups worth a row when a role is granted on the whole subscription,
+    # as (resource_count, resource_path), computed once per subscription rather than
+    # once per assignment.
+    nonzero_rgs = {
+        sub_key: [
+            (rg_data["resourceCount"], rg_data["id"])
+            for rg_data in sub_info["resourceGroups"].values()
+            if rg_data["resourceCount"] > 0
+        ]
+        for sub_key, sub_info in sub_map.items()
+    }
+
     # 4) For each user => principal => role => sub-scope => determine resource_count + resource_path
-    for name, principal_map in i_data.items():
-        for principal_id, details in principal_map.items():
-            display_name = details.get("displayName", "")
-            job_title    = details.get("jobTitle", "")
-            rbac_obj     = details.get("rbac", {})
-            if not isinstance(rbac_obj, dict):
-                continue
-
-            for role_bracket_key, sub_scopes_dict in rbac_obj.items():
-                role_label = parse_bracketed_label(role_bracket_key)
-                if not isinstance(sub_scopes_dict, dict):
+    # (with ijson installed only the current user's entry is held in memory)
+    try:
+        for name, principal_map in iter_json_object(i_combined_path):
+            for principal_id, details in principal_map.items():
+                display_name = details.get("displayName", "")
+                job_title    = details.get("jobTitle", "")
+                rbac_obj     = details.get("rbac", {})
+                if not isinstance(rbac_obj, dict):
                     continue
 
-                for _sc_br_key, scope_str in sub_scopes_dict.items():
-                    scope_str = scope_str.strip()
-                    # figure out subId if scope starts with "/subscriptions/"
-                    parts = scope_str.lower().split("/")
-                    sub_id_candidate = None
-                    if len(parts) > 2 and parts[1] == "subscriptions":
-                        sub_id_candidate = parts[2]
-
-                    rows_to_write = []  # we might expand multiple RGs if subscription-level
-
-                    if sub_id_candidate and sub_id_candidate in sub_map:
-                        sub_info = sub_map[sub_id_candidate]
-                        if is_subscription_scope(scope_str, sub_id_candidate):
-                            # expand all resource groups with resourceCount>0
-                            for rg_id_lower, rg_data in sub_info["resourceGroups"].items():
-                                rc = rg_data["resourceCount"]
-                                if rc == 0:
-                                    continue  # skip resource_count=0
-                                rows_to_write.append({
-                                    "name": name,
-                                    "displayName": display_name,
-                                    "jobTitle": job_title,
-                                    "principalID": principal_id,
-                                    "role": role_label,
-                                    "scope": scope_str,
-                                    "resource_count": rc,
-                                    "resource_path": rg_data["id"]
-                                })
+                for role_bracket_key, sub_scopes_dict in rbac_obj.items():
+                    if not isinstance(sub_scopes_dict, dict):
+                        continue
+                    role_label = parse_bracketed_label(role_bracket_key)
+
+                    for scope_str in sub_scopes_dict.values():
+                        scope_str = scope_str.strip()
+
+                        m = SUB_RE.match(scope_str)
+                        sub_key = m.group(1).lower() if m else None
+                        if sub_key not in sub_map:
+                            # not a known subscription => treat as resource => count=1
+                            targets = ((1, scope_str),)
+                        elif m.end() == len(scope_str):
+                            # subscription scope => every RG with resourceCount>0
+                            targets = nonzero_rgs[sub_key]
                         else:
                             # maybe RG or resource
-                            scope_lower = scope_str.lower()
-                            rg_data = sub_info["resourceGroups"].get(scope_lower)
-                            if rg_data:
-                                # exact RG
-                                rc = rg_data["resourceCount"]
-                                if rc > 0:
-                                    rows_to_write.append({
-                                        "name": name,
-                                        "displayName": display_name,
-                                        "jobTitle": job_title,
-                                        "principalID": principal_id,
-                                        "role": role_label,
-                                        "scope": scope_str,
-                                        "resource_count": rc,
-                                        "resource_path": rg_data["id"]
-                                    })
+                            rg_data = sub_map[sub_key]["resourceGroups"].get(scope_str.lower())
+                            if rg_data is None:
+                                # resource => resource_count=1
+                                targets = ((1, scope_str),)
+                            elif rg_data["resourceCount"] > 0:
+                                targets = ((rg_data["resourceCount"], rg_data["id"]),)
                             else:
-                                # resource => resource_count=1 unless 0 is possible
-                                # Typically a resource wouldn't be "0" unless it's an invalid scope
-                                # We'll store as 1
-                                rows_to_write.append({
-                                    "name": name,
-                                    "displayName": display_name,
-                                    "jobTitle": job_title,
-                                    "principalID": principal_id,
-                                    "role": role_label,
-                                    "scope": scope_str,
-                                    "resource_count": 1,
-                                    "resource_path": scope_str
-                                })
-                    else:
-                        # not a known subscription => treat as resource => count=1
-                        rows_to_write.append({
-                            "name": name,
-                            "displayName": display_name,
-                            "jobTitle": job_title,
-                            "principalID": principal_id,
-                            "role": role_label,
-                            "scope": scope_str,
-                            "resource_count": 1,
-                            "resource_path": scope_str
-                        })
-
-                    # now write only those with resource_count>0
-                    for row in rows_to_write:
-                        if row["resource_count"] > 0:
-                            writer.writerow(row)
+                                # empty RG => skip resource_count=0
+                                targets = ()
+
+                        for resource_count, resource_path in targets:
+                            writer.writerow((
+                                name, display_name, job_title, principal_id,
+                                role_label, scope_str, resource_count, resource_path
+                            ))
                             row_count += 1
+    except Exception as e:
+        out_f.close()
+        print(f"[ERROR] Could not load JSON from {i_combined_path}: {e}")
+        sys.exit(1)
 
     out_f.close()
     print(f"[INFO] Wrote {row_count} rows to {output_csv}")
 
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -14,41 +14,37 @@ Generates an above-average user bubble chart with pie slices per role.
   - Side role list => hover to highlight that role's slices in all circles.
 
 Usage:
-  python l_bubble_chart_users.py [optional_input_file]
+  python l_bubble_chart_users.py [optional_input_file] [--top-k K]
     Default input: output/i_combined_user_identities.json
+    --top-k: chart only the K largest above-average users (default 200, 0 = all)
 Output:
   output/l_bubble_chart_users.html
 """
 
 import os
 import sys
-import json
-
-def parse_bracketed_count(s: str) -> int:
-    if not s.startswith("[") or "]" not in s:
-        return 0
-    try:
-        inside = s[1 : s.index("]")]
-        return int(inside)
-    except ValueError:
-        return 0
-
-def parse_bracketed_label(s: str) -> str:
-    if not s.startswith("[") or "]" not in s:
-        return s
-    return s[s.index("]")+1:]
+import math
+import argparse
+from collections import Counter
+
+from helpers import iter_json_object, json_text, parse_bracketed, template_pieces
+
+# Above-average users charted by default; the rest are summarised in a note
+DEFAULT_TOP_K = 200
+
+# Counter.total() sums in C (Python 3.10+); older Pythons sum the values
+_counter_total = getattr(Counter, "total", lambda c: sum(c.values()))
 
 def merge_principal_rbac(rbac_dict, role_map):
     """
-    Merges the roles from one principal's RBAC into role_map.
+    Merges the roles from one principal's RBAC into role_map (a Counter).
     E.g. "[6]Contributor" => role_map["Contributor"] += 6
     """
     if not rbac_dict or not isinstance(rbac_dict, dict):
         return
     for role_key, _subdict in rbac_dict.items():
-        cnt = parse_bracketed_count(role_key)
-        lbl = parse_bracketed_label(role_key).strip()
-        role_map[lbl] = role_map.get(lbl, 0) + cnt
+        cnt, lbl = parse_bracketed(role_key)
+        role_map[lbl] += cnt
 
 def load_users_and_merge_principals(input_file: str):
     """
@@ -68,12 +64,10 @@ def load_users_and_merge_principals(input_file: str):
         ...
       ]
     """
-    with open(input_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
     user_list = []
-    for user_name, principal_map in data.items():
-        role_map = {}
+    # One user's entry at a time (parsed incrementally with ijson installed)
+    for user_name, principal_map in iter_json_object(input_file):
+        role_map = Counter()
         job_title = ""
         for pid, details in principal_map.items():
             if not job_title:
@@ -83,7 +77,7 @@ def load_users_and_merge_principals(input_file: str):
             rbac_obj = details.get("rbac", {})
             merge_principal_rbac(rbac_obj, role_map)
 
-        total_count = sum(role_map.values())
+        total_count = _counter_total(role_map)
         roles_list = [{"roleName":k, "count":v} for k,v in role_map.items()]
         user_list.append({
             "userName": user_name.strip().replace("_",""),
@@ -93,9 +87,23 @@ def load_users_and_merge_principals(input_file: str):
         })
     return user_list
 
-def generate_above_avg_html(user_data, out_html="output/l_bubble_chart_users.html"):
+def slice_angles(roles):
     """
-    Filters out users below average totalResourceCount.
+    Returns the cumulative pie-slice angles (radians, clockwise from 12 o'clock, in
+    role order like d3.pie().sort(null)) for a user's roles: [0, a1, ..., 2*pi].
+    """
+    total = sum(r["count"] for r in roles) or 1
+    angles = [0]
+    cum = 0
+    for r in roles:
+        cum += r["count"]
+        angles.append(round(math.tau * cum / total, 5))
+    return angles
+
+def generate_above_avg_html(user_data, out_html="output/l_bubble_chart_users.html", top_k=DEFAULT_TOP_K):
+    """
+    Filters out users below average totalResourceCount, then keeps the top_k largest
+    of the rest (top_k <= 0 keeps them all).
     Writes a bubble chart with pie slices per role to out_html.
     """
     if not user_data:
@@ -109,9 +117,24 @@ def generate_above_avg_html(user_data, out_html="output/l_bubble_chart_users.htm
         print(f"[INFO] No users above average ~{avg:.1f}.")
         return
 
-    filtered_json = json.dumps(filtered, ensure_ascii=False)
+    # Chart only the top_k largest, so huge tenants still get a usable page
+    hidden = 0
+    if 0 < top_k < len(filtered):
+        hidden = len(filtered) - top_k
+        filtered = sorted(filtered, key=lambda u: u["totalResourceCount"], reverse=True)[:top_k]
+    more_note = (
+        f"<p><em>…and {hidden} more above-average users not shown "
+        f"(top {top_k} by totalResourceCount).</em></p>"
+        if hidden else ""
+    )
+
+    # Slice geometry is fixed by the counts, so the page only has to draw it
+    for u in filtered:
+        u["angles"] = slice_angles(u["roles"])
+
+    filtered_json = json_text(filtered)
 
-    # Use .replace() to avoid Python interpreting JS braces as placeholders
+    # Markers are substituted by template_pieces(), so JS/CSS braces need no escaping
     html_template = r"""
 <!DOCTYPE html>
 <html lang="en">
@@ -179,10 +202,11 @@ def generate_above_avg_html(user_data, out_html="output/l_bubble_chart_users.htm
 Hover over a circle => show all roles for that user.<br/>
 Hover over a role => highlight those slices in all circles, outline circles that contain it.
 </p>
+~MORENOTE~
 
 <div id="container">
   <div id="chartColumn">
-    <div id="chart"></div>
+    <canvas id="chart" width="1500" height="1000"></canvas>
   </div>
   <div id="rolesColumn">
     <h3>All Roles (Filtered Users)</h3>
@@ -202,7 +226,7 @@ const userData = {filtered_json};
 const allRolesMap = new Map();
 const roleUserMap = new Map();
 
-userData.forEach(u => {
+userData.forEach((u, i) => {
   u.roles.forEach(r => {
     const prev = allRolesMap.get(r.roleName) || 0;
     allRolesMap.set(r.roleName, prev + r.count);
@@ -213,7 +237,8 @@ userData.forEach(u => {
     roleUserMap.get(r.roleName).push({
       userName: u.userName,
       jobTitle: u.jobTitle,
-      roleCount: r.count
+      roleCount: r.count,
+      node: i
     });
   });
 });
@@ -224,11 +249,19 @@ const allRoles = Array.from(allRolesMap.entries())
 
 const width = 3000;
 const height = 2000;
-const svg = d3.select("#chart")
-  .append("svg")
-  .attr("width", 1500)
-  .attr("height", 1000)
-  .attr("viewBox",[0,0,width,height]);
+
+// Everything is painted onto one canvas (no per-slice DOM nodes), in a
+// width x height coordinate space scaled down to the element's 1500x1000.
+const canvas = document.getElementById("chart");
+const dpr = window.devicePixelRatio || 1;
+canvas.style.width = canvas.width + "px";
+canvas.style.height = canvas.height + "px";
+const scale = canvas.width / width;
+canvas.width *= dpr;
+canvas.height *= dpr;
+const ctx = canvas.getContext("2d");
+// Chart-to-canvas transform (canvas = chart * k + t); zoomed out once the layout is known
+let k = scale, tx = 0, ty = 0;
 
 const tooltip = d3.select("#tooltip");
 const roleHoverBox = d3.select("#roleHoverBox");
@@ -243,78 +276,126 @@ const colorScale = d3.scaleOrdinal()
   .domain(roleNames)
   .range(d3.quantize(d3.interpolateRainbow, roleNames.length + 1));
 
-// Create node array
-let nodes = userData.map((u, i) => {
-  const roleSet = new Set(u.roles.map(rr => rr.roleName));
-  return {
-    index: i,
-    user: u,
-    userRoles: roleSet,
-    x: Math.random()*width,
-    y: Math.random()*height,
-    r: radiusScale(u.totalResourceCount)
-  };
-});
-
-const userGroups = svg.selectAll(".userGroup")
-  .data(nodes)
-  .enter()
-  .append("g")
-  .attr("class","userGroup");
-
-// Draw pie slices
-userGroups.each(function(nd) {
-  const g = d3.select(this);
-  const user = nd.user;
-  const userRadius = nd.r;
-  const rolesArr = user.roles;
-
-  const pie = d3.pie().sort(null).value(rr => rr.count);
-  const arcsData = pie(rolesArr);
-  const arcGen = d3.arc().innerRadius(0).outerRadius(userRadius);
-
-  g.selectAll(".slice")
-    .data(arcsData)
-    .enter()
-    .append("path")
-    .attr("class","slice")
-    .attr("d", arcGen)
-    .attr("fill", d => colorScale(d.data.roleName))
-    .attr("stroke","#333")
-    .attr("stroke-width",0.5);
-});
-
-// Outline circle for highlight
-userGroups.append("circle")
-  .attr("class","userOutline")
-  .attr("r", d => d.r)
-  .attr("fill","none")
-  .attr("stroke","none")
-  .attr("stroke-width",0);
-
-// Add text with userName in center
-userGroups.append("text")
-  .attr("text-anchor","middle")
-  .attr("dy","0.4em")
-  .text(d => d.user.userName)
-  .each(function(d) {
-    const textEl = d3.select(this);
-    let fontSize = 50;
-    textEl.style("font-size", fontSize+"px");
-    while(true) {
-      const bbox = textEl.node().getBBox();
-      const maxDim = Math.max(bbox.width,bbox.height);
-      if(maxDim <= 2*d.r || fontSize<=1) break;
-      fontSize--;
-      textEl.style("font-size", fontSize+"px");
+// Nodes are indexes into userData; their hot per-frame fields (position, radius,
+// label size) live in parallel typed arrays rather than one object per user
+const N = userData.length;
+const X = new Float32Array(N), Y = new Float32Array(N), R = new Float32Array(N);
+const fontSizes = new Float32Array(N);
+const fonts = new Array(N);
+// Slice fill colors, looked up once rather than on every redraw
+const sliceColors = new Array(N);
+for (let i = 0; i < N; i++) {
+  R[i] = radiusScale(userData[i].totalResourceCount);
+  sliceColors[i] = userData[i].roles.map(rr => colorScale(rr.roleName));
+}
+const maxR = d3.max(R) || 0;
+
+// Fit each userName inside its circle once: binary search for the largest
+// font size (1..50px) whose text box fits the circle's diameter
+for (let i = 0; i < N; i++) {
+  let lo = 1, hi = 50;
+  while (lo < hi) {
+    const mid = (lo + hi + 1) >> 1;
+    ctx.font = mid + "px sans-serif";
+    const m = ctx.measureText(userData[i].userName);
+    const maxDim = Math.max(m.width, m.fontBoundingBoxAscent + m.fontBoundingBoxDescent);
+    if (maxDim <= 2*R[i]) lo = mid; else hi = mid - 1;
+  }
+  fontSizes[i] = lo;
+  fonts[i] = lo + "px sans-serif";
+}
+
+// Role whose slices are highlighted (null => none)
+let highlightRole = null;
+
+function draw() {
+  ctx.setTransform(1, 0, 0, 1, 0, 0);
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.setTransform(k * dpr, 0, 0, k * dpr, tx * dpr, ty * dpr);
+  ctx.lineWidth = 0.5;
+  ctx.strokeStyle = "#333";
+  for (let i = 0; i < N; i++) {
+    // Pie slices, from the angles precomputed in Python
+    // (canvas angle 0 is 3 o'clock, so shift by a quarter turn)
+    const x = X[i], y = Y[i], r = R[i];
+    const roles = userData[i].roles, angles = userData[i].angles, colors = sliceColors[i];
+    for (let j = 0; j < roles.length; j++) {
+      ctx.globalAlpha = (highlightRole === null || roles[j].roleName === highlightRole) ? 1 : 0.15;
+      ctx.beginPath();
+      ctx.moveTo(x, y);
+      ctx.arc(x, y, r, angles[j] - Math.PI/2, angles[j + 1] - Math.PI/2);
+      ctx.closePath();
+      ctx.fillStyle = colors[j];
+      ctx.fill();
+      ctx.stroke();
     }
+    ctx.globalAlpha = 1;
+  }
+  // Outline the circles of the users holding the highlighted role
+  if (highlightRole !== null) {
+    ctx.lineWidth = 2;
+    ctx.strokeStyle = "black";
+    for (const entry of roleUserMap.get(highlightRole) || []) {
+      const i = entry.node;
+      ctx.beginPath();
+      ctx.arc(X[i], Y[i], R[i], 0, 2 * Math.PI);
+      ctx.stroke();
+    }
+  }
+  // userName in center
+  ctx.fillStyle = "black";
+  ctx.textAlign = "center";
+  for (let i = 0; i < N; i++) {
+    ctx.font = fonts[i];
+    ctx.fillText(userData[i].userName, X[i], Y[i] + 0.4 * fontSizes[i]);
+  }
+}
+
+// Coalesce redraws into the next animation frame, so the mouseout/mouseover pair
+// fired when moving between roles repaints the canvas once, off the event handler
+let drawPending = false;
+function requestDraw() {
+  if (drawPending) return;
+  drawPending = true;
+  requestAnimationFrame(() => {
+    drawPending = false;
+    draw();
   });
-
-// Group-level hover => show all roles in tooltip
-userGroups
-  .on("mouseover", function(evt, nd) {
-    tooltip.style("opacity",1);
-    const user = nd.user;
+}
+
+// Hit-testing for hover: a quadtree over the circle centers, built on first use.
+// Returns the node index under (mx, my), or -1.
+let qt = null;
+function findNode(mx, my) {
+  if (qt === null) {
+    qt = d3.quadtree().x(i => X[i]).y(i => Y[i]).addAll(d3.range(N));
+  }
+  let hit = -1;
+  qt.visit((q, x0, y0, x1, y1) => {
+    if (!q.length) {
+      let leaf = q;
+      do {
+        const i = leaf.data;
+        if ((X[i] - mx) ** 2 + (Y[i] - my) ** 2 <= R[i] * R[i]) hit = i;
+      } while ((leaf = leaf.next));
+    }
+    return hit !== -1 || x0 > mx + maxR || x1 < mx - maxR || y0 > my + maxR || y1 < my - maxR;
+  });
+  return hit;
+}
+
+// Circle hover => show all roles in tooltip
+let hoveredNode = -1;
+canvas.addEventListener("mousemove", evt => {
+  const i = findNode((evt.offsetX - tx) / k, (evt.offsetY - ty) / k);
+  if (i === -1) {
+    hoveredNode = -1;
+    tooltip.style("opacity",0);
+    return;
+  }
+  if (i !== hoveredNode) {
+    hoveredNode = i;
+    const user = userData[i];
     const lines = user.roles.map(r => `(${r.count}) ${r.roleName}`).join("<br/>");
     const html = `
       <div><strong>User:</strong> ${user.userName}</div>
@@ -322,32 +403,32 @@ userGroups
       <div><strong>All Roles:</strong><br/>${lines}</div>
     `;
     tooltip.html(html);
-  })
-  .on("mousemove", function(evt) {
-    tooltip
-      .style("left",(evt.pageX+10)+"px")
-      .style("top",(evt.pageY+10)+"px");
-  })
-  .on("mouseout", function() {
-    tooltip.style("opacity",0);
-  });
+  }
+  tooltip
+    .style("opacity",1)
+    .style("left",(evt.pageX+10)+"px")
+    .style("top",(evt.pageY+10)+"px");
+});
+canvas.addEventListener("mouseleave", () => {
+  hoveredNode = -1;
+  tooltip.style("opacity",0);
+});
 
-// Force simulation
-const simulation = d3.forceSimulation(nodes)
-  .force("center", d3.forceCenter(width/2, height/2))
-  .force("x", d3.forceX(width/2).strength(0.2))
-  .force("y", d3.forceY(height/2).strength(0.2))
-  .force("charge", d3.forceManyBody().strength(0))
-  .force("collision", d3.forceCollide().radius(d => d.r).strength(1))
-  .on("tick", () => {
-    nodes.forEach(d => {
-      if(d.x<d.r) d.x=d.r;
-      if(d.x>width-d.r) d.x=width-d.r;
-      if(d.y<d.r) d.y=d.r;
-      if(d.y>height-d.r) d.y=height-d.r;
-    });
-    userGroups.attr("transform", d => `translate(${d.x},${d.y})`);
-  });
+// Static layout: pack the circles once (largest first) around the middle of the chart.
+// packSiblings needs {r} objects; the positions are then copied into X/Y.
+const circles = Array.from(R, r => ({ r }));
+d3.packSiblings(circles.slice().sort((a,b) => b.r - a.r));
+const enclosing = d3.packEnclose(circles);
+for (let i = 0; i < N; i++) {
+  X[i] = circles[i].x + width/2 - enclosing.x;
+  Y[i] = circles[i].y + height/2 - enclosing.y;
+}
+// Zoom out about the chart center if the packed bubbles would overflow it
+const fit = Math.min(1, Math.min(width, height) / (2 * enclosing.r));
+k = scale * fit;
+tx = width/2 * (scale - k);
+ty = height/2 * (scale - k);
+draw();
 
 // Build role list in side column
 const roleContainer = d3.select("#roleItems");
@@ -360,15 +441,8 @@ roleContainer.selectAll(".roleListItem")
   .text(d => d.totalCount+" - "+d.roleName)
   .on("mouseover", function(evt,d) {
     const roleName = d.roleName;
-    svg.selectAll(".slice")
-      .transition().duration(100)
-      .style("opacity", sliceDatum => {
-        return (sliceDatum.data.roleName===roleName)? 1 : 0.15;
-      });
-    userGroups.select(".userOutline")
-      .transition().duration(100)
-      .attr("stroke", nd => nd.userRoles.has(roleName)? "black":"none")
-      .attr("stroke-width", nd => nd.userRoles.has(roleName)? 2:0);
+    highlightRole = roleName;
+    requestDraw();
 
     const userList = roleUserMap.get(roleName) || [];
     userList.sort((a,b) => b.roleCount - a.roleCount);
@@ -376,13 +450,8 @@ roleContainer.selectAll(".roleListItem")
     d3.select("#roleHoverBox").html(lines.join("\n"));
   })
   .on("mouseout", function() {
-    svg.selectAll(".slice")
-      .transition().duration(100)
-      .style("opacity",1);
-    userGroups.select(".userOutline")
-      .transition().duration(100)
-      .attr("stroke","none")
-      .attr("stroke-width",0);
+    highlightRole = null;
+    requestDraw();
     d3.select("#roleHoverBox").html("");
   });
 
@@ -391,20 +460,29 @@ roleContainer.selectAll(".roleListItem")
 </html>
 """
 
-    final_html = html_template.replace("~AVGCOUNT~", f"{avg:.1f}")
-    final_html = final_html.replace("{filtered_json}", filtered_json)
+    html_pieces = template_pieces(html_template, {
+        "~AVGCOUNT~": f"{avg:.1f}",
+        "~MORENOTE~": more_note,
+        "{filtered_json}": filtered_json,
+    })
 
     os.makedirs(os.path.dirname(out_html), exist_ok=True)
     with open(out_html, "w", encoding="utf-8") as f:
-        f.write(final_html)
+        f.writelines(html_pieces)
 
-    print(f"[INFO] Wrote => {out_html} ({len(filtered)} users above ~{avg:.1f} avg).")
+    print(f"[INFO] Wrote => {out_html} ({len(filtered) + hidden} users above ~{avg:.1f} avg, {len(filtered)} charted).")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bubble chart of above-average users, pie-sliced by role.")
+    parser.add_argument("input_file", nargs="?", default="output/i_combined_user_identities.json",
+                        help="combined identities JSON (default: %(default)s)")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K,
+                        help="chart only the K largest above-average users; 0 charts all (default: %(default)s)")
+    return parser.parse_args(argv)
 
 def main():
-    if len(sys.argv) > 1:
-        input_file = sys.argv[1]
-    else:
-        input_file = "output/i_combined_user_identities.json"
+    args = parse_args()
+    input_file = args.input_file
 
     if not os.path.exists(input_file):
         print(f"[ERROR] {input_file} not found.")
@@ -415,8 +493,12 @@ def main():
         print("[WARN] No user data.")
         return
 
-    generate_above_avg_html(user_data, "output/l_bubble_chart_users.html")
+    generate_above_avg_html(user_data, "output/l_bubble_chart_users.html", top_k=args.top_k)
     print("[INFO] Done! Open 'output/l_bubble_chart_users.html' in your browser.")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
@@ -2,27 +2,32 @@
 """
 m_bubble_chart_roles_all.py
 
-Displays *all* roles in a bubble chart, regardless of assignment counts.
+Displays the most-assigned roles (the top 200 by default) in a bubble chart; the
+number of roles left out is noted on the page.
 
 It calculates the count for each role by summing the number of scope entries.
 
 Usage:
-  python m_bubble_chart_roles_all.py [optional_input_file]
+  python m_bubble_chart_roles_all.py [optional_input_file] [--top-k K]
+
+--top-k: chart only the K most-assigned roles (default 200, 0 = all).
 
 Default input: "output/i_combined_user_identities.json"
-Output: "output/m_bubble_chart_roles.html"
+Output: "output/m_bubble_chart_roles.html", plus "output/m_bubble_chart_roles.scopes.js"
+        (each role's scope list, loaded by the page the first time a role is hovered;
+        the page finds it by its own file name, so the pair can be renamed together)
 """
 
 import os
 import sys
-import json
 import math
+import argparse
+from collections import Counter, defaultdict
+
+from helpers import iter_json_object, json_text, parse_bracketed_label, template_pieces
 
-def parse_bracketed_label(s: str) -> str:
-    """Given '[4845]Virtual Machine Contributor', returns 'Virtual Machine Contributor'."""
-    if not s.startswith("[") or "]" not in s:
-        return s
-    return s[s.index("]") + 1 :].strip()
+# Roles charted by default; the rest are summarised in a note
+DEFAULT_TOP_K = 200
 
 def accumulate_role_assignments(rbac_obj: dict, role_assign_map: dict, role_scopes_map: dict):
     """
@@ -41,53 +46,69 @@ def accumulate_role_assignments(rbac_obj: dict, role_assign_map: dict, role_scop
         if count_here == 0:
             continue
         # Accumulate
-        role_assign_map[role_label] = role_assign_map.get(role_label, 0) + count_here
-        # Collect scope strings
-        if role_label not in role_scopes_map:
-            role_scopes_map[role_label] = set()
-        for _scope_bracket, scope_str in sub_dict.items():
-            role_scopes_map[role_label].add(scope_str)
+        role_assign_map[role_label] += count_here
+        # Collect scope strings, interned so a scope shared by many roles/users is
+        # stored (and compared) as one object
+        role_scopes_map[role_label].update(map(sys.intern, sub_dict.values()))
 
 def build_role_assignment_map(input_file: str):
     """
     Returns:
-      role_assign_map => { "Virtual Machine Contributor": total_count, ... }
-      role_scopes_map => { "Virtual Machine Contributor": set_of_scope_strings, ... }
+      role_assign_map => Counter { "Virtual Machine Contributor": total_count, ... }
+      role_scopes_map => defaultdict(set) { "Virtual Machine Contributor": set_of_scope_strings, ... }
     """
-    with open(input_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    role_assign_map = {}
-    role_scopes_map = {}
+    role_assign_map = Counter()
+    role_scopes_map = defaultdict(set)
 
-    for _user_name, principal_map in data.items():
+    # One user's entry at a time (parsed incrementally with ijson installed)
+    for _user_name, principal_map in iter_json_object(input_file):
         for _pid, details in principal_map.items():
             rbac_obj = details.get("rbac", {})
             accumulate_role_assignments(rbac_obj, role_assign_map, role_scopes_map)
 
     return (role_assign_map, role_scopes_map)
 
-def generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bubble_chart_roles.html"):
+def generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bubble_chart_roles.html",
+                        top_k=DEFAULT_TOP_K):
     """
-    Builds a bubble chart for all roles and writes to HTML.
+    Builds a bubble chart for the top_k most-assigned roles (top_k <= 0 => all roles)
+    and writes to HTML.
     """
-    # Build a list of role records
+    # Chart only the top_k largest, so huge tenants still get a usable page
+    role_counts = role_assign_map.items()
+    hidden = 0
+    if 0 < top_k < len(role_assign_map):
+        hidden = len(role_assign_map) - top_k
+        role_counts = role_assign_map.most_common(top_k)
+
+    # Build a list of role records; the (possibly long) scope lists go to a sibling
+    # script instead of the page itself
     role_list = []
-    for rname, rcount in role_assign_map.items():
+    role_scopes = {}
+    for rname, rcount in role_counts:
         scopes_set = role_scopes_map.get(rname, set())
         role_list.append({
             "roleName": rname,
             "assignmentCount": rcount,
-            "scopes": sorted(list(scopes_set))
+            "scopeCount": len(scopes_set)
         })
+        role_scopes[rname] = sorted(scopes_set)
 
     if not role_list:
         print("[INFO] No roles found at all.")
         return
 
     # Convert to JSON
-    import json
-    final_json = json.dumps(role_list, ensure_ascii=False)
+    final_json = json_text(role_list)
+    scopes_js = os.path.splitext(out_html)[0] + ".scopes.js"
+    intro = (
+        f"The {top_k} most-assigned roles are shown here, sized by their assignment count."
+        if hidden else "Every discovered role is shown here, sized by its assignment count."
+    )
+    more_note = (
+        f"<p><em>…and {hidden} more roles not shown (top {top_k} by assignment count).</em></p>"
+        if hidden else ""
+    )
 
     # Build the bubble chart
     html_template = r"""
@@ -95,7 +116,7 @@ def generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bub
 <html lang="en">
 <head>
   <meta charset="UTF-8" />
-  <title>All Roles Bubble Chart</title>
+  <title>Top Roles Bubble Chart</title>
   <script src="https://d3js.org/d3.v7.min.js"></script>
   <style>
     body {
@@ -122,8 +143,9 @@ def generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bub
   </style>
 </head>
 <body>
-<h2>All Roles Bubble Chart</h2>
-<p>Every discovered role is shown here, sized by its assignment count.</p>
+<h2>Top Roles Bubble Chart</h2>
+<p>{intro}</p>
+{more_note}
 
 <div id="chart"></div>
 <div class="tooltip" id="tooltip"></div>
@@ -156,9 +178,7 @@ let nodes = roleData.map((r,i) => {
     index: i,
     roleName: r.roleName,
     assignmentCount: r.assignmentCount,
-    scopes: r.scopes,
-    x: Math.random()*width,
-    y: Math.random()*height,
+    scopeCount: r.scopeCount,
     r: radiusScale(r.assignmentCount)
   };
 });
@@ -169,20 +189,51 @@ const nodeG = svg.selectAll(".roleNode")
   .append("g")
   .attr("class","roleNode");
 
+// Scope lists live in a sibling script, loaded the first time a role is hovered
+// (a <script> tag rather than fetch(), which browsers block for file:// pages).
+// Its name follows this page's own (<page>.html => <page>.scopes.js), so it still
+// resolves after the orchestrator copies both files into FINAL_OUTPUT under new names.
+const scopesSrc = location.pathname.replace(/\.html?$/i, "") + ".scopes.js";
+let scopesPromise = null;
+function loadScopes() {
+  if (scopesPromise === null) {
+    scopesPromise = new Promise((resolve, reject) => {
+      const script = document.createElement("script");
+      script.src = scopesSrc;
+      script.onload = () => resolve(window.roleScopes || {});
+      script.onerror = () => reject(new Error("could not load " + decodeURIComponent(scopesSrc.split("/").pop())));
+      document.head.appendChild(script);
+    });
+  }
+  return scopesPromise;
+}
+
+function roleTooltipHtml(d, scopesList) {
+  return `
+      <div><strong>Role:</strong> ${d.roleName}</div>
+      <div><strong>AssignmentCount:</strong> ${d.assignmentCount}</div>
+      <div><strong>Distinct Scopes (${d.scopeCount}):</strong><br/>${scopesList}</div>
+    `;
+}
+
+let hoveredRole = null;
+
 nodeG.append("circle")
   .attr("r", d => d.r)
   .attr("fill", d => colorScale(d.roleName))
   .attr("stroke", "#333")
   .attr("stroke-width", 0.5)
   .on("mouseover", function(evt, d) {
+    hoveredRole = d;
     tooltip.style("opacity", 1);
-    const scopesList = d.scopes.map(s => "- " + s).join("<br/>");
-    const html = `
-      <div><strong>Role:</strong> ${d.roleName}</div>
-      <div><strong>AssignmentCount:</strong> ${d.assignmentCount}</div>
-      <div><strong>Distinct Scopes:</strong><br/>${scopesList}</div>
-    `;
-    tooltip.html(html);
+    tooltip.html(roleTooltipHtml(d, "loading…"));
+    loadScopes().then(scopeMap => {
+      if (hoveredRole !== d) return;
+      const scopesList = (scopeMap[d.roleName] || []).map(s => "- " + s).join("<br/>");
+      tooltip.html(roleTooltipHtml(d, scopesList));
+    }, err => {
+      if (hoveredRole === d) tooltip.html(roleTooltipHtml(d, err.message));
+    });
   })
   .on("mousemove", function(evt) {
     tooltip
@@ -190,6 +241,7 @@ nodeG.append("circle")
       .style("top", (evt.pageY+10) + "px");
   })
   .on("mouseout", function() {
+    hoveredRole = null;
     tooltip.style("opacity", 0);
   });
 
@@ -200,57 +252,72 @@ nodeG.each(function(d) {
     .attr("dy","0.4em")
     .text(d.roleName);
 
-  let fontSize = 40;
-  textEl.style("font-size", fontSize + "px");
-  while(true) {
+  // Binary search for the largest font size (1..40px) that fits the circle,
+  // so each label costs ~6 getBBox() layout flushes instead of up to 40
+  let lo = 1, hi = 40;
+  while (lo < hi) {
+    const mid = (lo + hi + 1) >> 1;
+    textEl.style("font-size", mid + "px");
     const bbox = textEl.node().getBBox();
-    const maxDim = Math.max(bbox.width,bbox.height);
-    if(maxDim <= 2*d.r || fontSize<=1) break;
-    fontSize--;
-    textEl.style("font-size", fontSize+"px");
+    if (Math.max(bbox.width, bbox.height) <= 2*d.r) lo = mid; else hi = mid - 1;
   }
+  textEl.style("font-size", lo + "px");
 });
 
-const simulation = d3.forceSimulation(nodes)
-  .force("center", d3.forceCenter(width/2,height/2))
-  .force("x", d3.forceX(width/2).strength(0.2))
-  .force("y", d3.forceY(height/2).strength(0.2))
-  .force("charge", d3.forceManyBody().strength(0))
-  .force("collision", d3.forceCollide().radius(d => d.r).strength(1))
-  .on("tick", () => {
-    nodes.forEach(d => {
-      if(d.x<d.r) d.x=d.r;
-      if(d.x>width-d.r) d.x=width-d.r;
-      if(d.y<d.r) d.y=d.r;
-      if(d.y>height-d.r) d.y=height-d.r;
-    });
-    nodeG.attr("transform", d => `translate(${d.x},${d.y})`);
-  });
+// Static layout: pack the circles once (largest first) around the middle of the chart
+d3.packSiblings(nodes.slice().sort((a,b) => b.r - a.r));
+const enclosing = d3.packEnclose(nodes);
+nodes.forEach(d => {
+  d.x += width/2 - enclosing.x;
+  d.y += height/2 - enclosing.y;
+});
+// Zoom out about the chart center if the packed bubbles would overflow it
+const fit = Math.min(1, Math.min(width, height) / (2 * enclosing.r));
+svg.attr("viewBox", [width/2 * (1 - 1/fit), height/2 * (1 - 1/fit), width/fit, height/fit]);
+// One plain setAttribute per group (whole units, no D3 selection callbacks)
+const gNodes = nodeG.nodes();
+for (let i = 0; i < nodes.length; i++) {
+  const d = nodes[i];
+  gNodes[i].setAttribute("transform", "translate(" + Math.round(d.x) + "," + Math.round(d.y) + ")");
+}
 </script>
 </body>
 </html>
 """
 
-    final_html = html_template.replace("{final_json}", final_json)
+    html_pieces = template_pieces(html_template, {
+        "{final_json}": final_json,
+        "{intro}": intro,
+        "{more_note}": more_note,
+    })
 
     os.makedirs(os.path.dirname(out_html), exist_ok=True)
     with open(out_html, "w", encoding="utf-8") as f:
-        f.write(final_html)
+        f.writelines(html_pieces)
+    with open(scopes_js, "w", encoding="utf-8") as f:
+        f.write("window.roleScopes = " + json_text(role_scopes) + ";\n")
+
+    print(f"[INFO] Wrote => {out_html} (+ {scopes_js})")
+    print(f"[INFO] Total roles displayed: {len(role_list)} of {len(role_list) + hidden}")
 
-    print(f"[INFO] Wrote => {out_html}")
-    print(f"[INFO] Total roles displayed: {len(role_list)}")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bubble chart of the most-assigned roles (see --top-k), sized by assignment count.")
+    parser.add_argument("input_file", nargs="?", default="output/i_combined_user_identities.json",
+                        help="combined identities JSON (default: %(default)s)")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K,
+                        help="chart only the K most-assigned roles; 0 charts all (default: %(default)s)")
+    return parser.parse_args(argv)
 
 def main():
     """
     Usage:
-      python m_bubble_chart_roles_all.py [optionalInputFile]
+      python m_bubble_chart_roles_all.py [optionalInputFile] [--top-k K]
 
-    Displays a bubble chart of all roles, sized by their assignment count.
+    Displays a bubble chart of the top K roles (default 200; 0 = all), sized by their
+    assignment count.
     """
-    if len(sys.argv) > 1:
-        input_file = sys.argv[1]
-    else:
-        input_file = "output/i_combined_user_identities.json"
+    args = parse_args()
+    input_file = args.input_file
 
     if not os.path.exists(input_file):
         print(f"[ERROR] File not found: {input_file}")
@@ -261,8 +328,13 @@ def main():
         print("[INFO] No roles discovered.")
         return
 
-    generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bubble_chart_roles.html")
+    generate_roles_html(role_assign_map, role_scopes_map, out_html="output/m_bubble_chart_roles.html",
+                        top_k=args.top_k)
     print("[INFO] Done! Open 'output/m_bubble_chart_roles.html' in your browser.")
 
-if __name__ == "__main__":
+def run() -> None:
+    """Entry point used by the AzureEnumRBAC orchestrator."""
     main()
+
+if __name__ == "__main__":
+    run()
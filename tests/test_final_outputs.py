@@ -0,0 +1,76 @@
+"""
+Checks that the role bubble chart still finds its scopes sidecar after the
+orchestrator copies the final outputs (prefix stripped) into FINAL_OUTPUT.
+
+Run from the repository root:
+  python -m unittest discover -s tests
+"""
+
+import io
+import json
+import os
+import re
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from AzureEnumRBAC import AzureEnumRBAC as orchestrator
+
+# Importable once the orchestrator has put the package directory on sys.path
+import m_bubble_chart_roles
+
+IDENTITIES = {
+    "Ann": {
+        "pid-1": {
+            "displayName": "Ann",
+            "jobTitle": "Eng",
+            "rbac": {
+                "[2]Owner": {"[1]a": "/subscriptions/a", "[1]b": "/subscriptions/b"},
+                "[1]Reader": {"[1]a": "/subscriptions/a"},
+            },
+        }
+    }
+}
+
+
+class FinalOutputsTest(unittest.TestCase):
+    def test_role_chart_scopes_sidecar_survives_copy(self):
+        with tempfile.TemporaryDirectory() as base:
+            output_dir = os.path.join(base, "output")
+            final_dir = os.path.join(base, "FINAL_OUTPUT")
+            os.makedirs(output_dir)
+            input_file = os.path.join(output_dir, "i_combined_user_identities.json")
+            with open(input_file, "w", encoding="utf-8") as f:
+                json.dump(IDENTITIES, f)
+
+            saved = orchestrator.USER_OUTPUT_DIR, orchestrator.USER_FINAL_DIR
+            orchestrator.USER_OUTPUT_DIR, orchestrator.USER_FINAL_DIR = output_dir, final_dir
+            try:
+                with redirect_stdout(io.StringIO()):
+                    role_assign_map, role_scopes_map = m_bubble_chart_roles.build_role_assignment_map(input_file)
+                    m_bubble_chart_roles.generate_roles_html(
+                        role_assign_map, role_scopes_map,
+                        out_html=os.path.join(output_dir, "m_bubble_chart_roles.html"),
+                    )
+                    orchestrator.copy_final_outputs()
+            finally:
+                orchestrator.USER_OUTPUT_DIR, orchestrator.USER_FINAL_DIR = saved
+
+            html_path = os.path.join(final_dir, "bubble_chart_roles.html")
+            with open(html_path, encoding="utf-8") as f:
+                html = f.read()
+
+            # The page derives the sidecar from its own name (<page>.html => <page>.scopes.js)
+            self.assertNotIn("m_bubble_chart_roles.scopes.js", html)
+            match = re.search(r'location\.pathname\.replace\(/\\\.html\?\$/i, ""\) \+ "([^"]+)"', html)
+            self.assertIsNotNone(match, "page no longer derives its scopes file name")
+            referenced = os.path.splitext(html_path)[0] + match.group(1)
+            self.assertTrue(os.path.exists(referenced), f"{referenced} missing from FINAL_OUTPUT")
+
+            with open(referenced, encoding="utf-8") as f:
+                scopes = json.loads(f.read().split("=", 1)[1].rstrip().rstrip(";"))
+            self.assertEqual(scopes["Owner"], ["/subscriptions/a", "/subscriptions/b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Checks that phase a runs unattended: with stdin closed it must not prompt,
+install the CLI or start 'az login', and must cache the existing login's tokens.
+
+Run from the repository root:
+  python -m unittest discover -s tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AzureEnumRBAC")
+
+# Stand-in for the az CLI: records its arguments and answers get-access-token
+FAKE_AZ = textwrap.dedent("""\
+    #!{python}
+    import json, sys, time
+    with open({calls!r}, "a") as f:
+        f.write(" ".join(sys.argv[1:]) + "\\n")
+    if sys.argv[1:3] == ["account", "get-access-token"]:
+        print(json.dumps({{"accessToken": "token", "expires_on": int(time.time()) + 3600}}))
+    """)
+
+
+@unittest.skipUnless(os.name == "posix", "uses a shell-script stand-in for az")
+class LoginUnattendedTest(unittest.TestCase):
+    def test_closed_stdin_takes_defaults(self):
+        with tempfile.TemporaryDirectory() as base:
+            bin_dir = os.path.join(base, "bin")
+            os.makedirs(bin_dir)
+            calls = os.path.join(base, "az_calls.txt")
+            az = os.path.join(bin_dir, "az")
+            with open(az, "w", encoding="utf-8") as f:
+                f.write(FAKE_AZ.format(python=sys.executable, calls=calls))
+            os.chmod(az, 0o755)
+
+            env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""), HOME=base)
+            env.pop("AZUREENUMRBAC_NONINTERACTIVE", None)
+            result = subprocess.run(
+                [sys.executable, os.path.join(PACKAGE_DIR, "a_login_or_install.py")],
+                cwd=base, env=env, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=60,
+                # Close stdin outright in the child rather than leaving /dev/null on it
+                preexec_fn=lambda: os.close(0),
+            )
+
+            self.assertEqual(result.returncode, 0, result.stdout)
+            self.assertIn("Login skipped.", result.stdout)
+            with open(calls, encoding="utf-8") as f:
+                az_calls = f.read().splitlines()
+            self.assertNotIn("login", az_calls)
+            self.assertTrue(all(c.startswith("account get-access-token") for c in az_calls), az_calls)
+            with open(os.path.join(base, "output", "token.json"), encoding="utf-8") as f:
+                self.assertEqual(json.load(f)["accessToken"], "token")
+
+
+if __name__ == "__main__":
+    unittest.main()
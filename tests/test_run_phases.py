@@ -0,0 +1,78 @@
+"""
+Checks that a phase raising an ordinary exception fails the run the same way a
+non-zero sys.exit does: a phase_fail event, no new phases started, and the
+phases already running allowed to finish.
+
+Run from the repository root:
+  python -m unittest discover -s tests
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+from AzureEnumRBAC import AzureEnumRBAC as orchestrator
+
+
+def fake_phase(name, run):
+    module = types.ModuleType(name)
+    module.run = run
+    return module
+
+
+def crash():
+    raise KeyError("missing")
+
+
+class RunPhasesTest(unittest.TestCase):
+    def test_phase_exception_fails_like_nonzero_exit(self):
+        started = []
+        phases = {
+            "p1_ok": fake_phase("p1_ok", lambda: started.append("p1_ok")),
+            "p2_crash": fake_phase("p2_crash", crash),
+            "p3_slow": fake_phase("p3_slow", lambda: (time.sleep(0.2), started.append("p3_slow"))),
+            "p4_after_crash": fake_phase("p4_after_crash", lambda: started.append("p4_after_crash")),
+        }
+        dependencies = {
+            "p1_ok": [],
+            "p2_crash": ["p1_ok"],
+            "p3_slow": ["p1_ok"],
+            "p4_after_crash": ["p2_crash"],
+        }
+
+        saved = orchestrator.SCRIPTS_IN_ORDER, orchestrator.PHASE_DEPENDENCIES
+        orchestrator.SCRIPTS_IN_ORDER, orchestrator.PHASE_DEPENDENCIES = list(phases), dependencies
+        sys.modules.update(phases)
+        stderr = io.StringIO()
+        try:
+            with tempfile.TemporaryDirectory() as base:
+                run_log = orchestrator.RunLog(os.path.join(base, "run.log"))
+                try:
+                    with redirect_stdout(io.StringIO()), redirect_stderr(stderr):
+                        with self.assertRaises(SystemExit) as raised:
+                            orchestrator.run_phases(run_log)
+                    completed = run_log.completed
+                finally:
+                    run_log.close()
+        finally:
+            orchestrator.SCRIPTS_IN_ORDER, orchestrator.PHASE_DEPENDENCIES = saved
+            for name in phases:
+                sys.modules.pop(name, None)
+
+        self.assertEqual(raised.exception.code, 1)
+        events = [json.loads(line) for line in stderr.getvalue().splitlines() if line.startswith("{")]
+        fails = [e for e in events if e["evt"] == "phase_fail"]
+        self.assertEqual([(e["name"], e["rc"]) for e in fails], [("p2_crash", 1)])
+        self.assertEqual(completed, {"p1_ok", "p3_slow"})
+        self.assertNotIn("p4_after_crash", started)
+        self.assertIn("KeyError", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()